@@ -0,0 +1,157 @@
+import os
+import gc
+import time
+import logging
+import statistics
+from datetime import datetime
+from utils import (
+    print_system,
+    suppress_stderr,
+    model_params,
+    load_hardware_profiles,
+    save_hardware_profiles,
+    hardware_profile_name
+)
+
+# ==========================================================
+#                     TUNING BENCHMARK
+# ==========================================================
+TUNED_KEYS = ("n_gpu_layers", "n_threads", "n_batch", "n_ubatch", "flash_attn")
+BENCH_PROMPT = (
+    "You are a helpful AI chatbot.\n### Context:\n"
+    + "The user and the assistant talked about cats, bubble tea, plush toys, rainy days and surreal dreams. " * 24
+    + "\n### Instruction:\nUser: Tell me a short story about a cat who opens a tea shop.\n### Response:\nAssistant:"
+)
+REFERENCE_PROMPT_TOKENS = 1024                                  # a typical turn: prompt tokens evaluated ...
+REFERENCE_GEN_TOKENS = 256                                      # ... and reply tokens generated
+BATCH_SIZES = [256, 512, 1024, 2048]
+UBATCH_SIZES = [128, 256, 512, 1024]
+BENCH_GEN_TOKENS = 64
+BENCH_REPEATS = 3
+
+def cpu_core_counts() -> tuple:
+    logical = os.cpu_count() or 1
+    try:
+        import psutil
+        physical = psutil.cpu_count(logical=False) or logical
+    except ImportError:
+        physical = max(1, logical // 2)
+    return physical, logical
+
+def gpu_offload_supported() -> bool:
+    try:
+        from llama_cpp import llama_cpp as llama_lib
+        return bool(llama_lib.llama_supports_gpu_offload())
+    except Exception:
+        return False
+
+def bench_prompt_length(config: dict) -> int:
+    """The benchmark prompt is as long as the largest n_batch candidate that fits in the context, so every batch size is exercised."""
+    return min(max(BATCH_SIZES), config["n_ctx"] - BENCH_GEN_TOKENS - 1)
+
+def bench_tokens(llm, n_tokens: int) -> list:
+    """BENCH_PROMPT tokenized and its body repeated until it is exactly n_tokens long."""
+    tokens = llm.tokenize(BENCH_PROMPT.encode("utf-8"))
+    body = tokens[1:] or tokens
+    while len(tokens) < n_tokens:
+        tokens += body
+    return tokens[:n_tokens]
+
+def candidate_values(config: dict) -> dict:
+    physical, logical = cpu_core_counts()
+    threads = sorted({max(1, physical // 2), physical, logical, min(config["n_threads"], logical)})
+    gpu_layers = sorted({0, config["n_gpu_layers"], -1}, key=lambda n: 10**9 if n < 0 else n) if gpu_offload_supported() else [0]
+    return {
+        "n_gpu_layers": gpu_layers,
+        "n_threads": threads,
+        "n_batch": [n for n in BATCH_SIZES if n <= bench_prompt_length(config)],     # larger batches would time the same single batch
+        "n_ubatch": [n for n in UBATCH_SIZES if n <= bench_prompt_length(config)],
+        "flash_attn": [False, True],
+    }
+
+def measure(config: dict, settings: dict, n_gen: int = BENCH_GEN_TOKENS, repeats: int = BENCH_REPEATS) -> dict:
+    """
+    Loads the model with the given settings and measures prompt-eval and generation throughput on the benchmark
+    prompt, taking the median of repeats runs of each so a single noisy timing cannot pick the winner.
+    Returns None if the model cannot be loaded with these settings (e.g. not enough VRAM).
+    """
+    from llama_cpp import Llama
+    params = model_params(config)
+    params.update(settings)
+    params["n_threads_batch"] = params["n_threads"]
+    llm = None
+    try:
+        with suppress_stderr():
+            llm = Llama(**params, verbose=False)
+        tokens = bench_tokens(llm, bench_prompt_length(config))
+        prompt_runs = []
+        gen_runs = []
+        for _ in range(repeats):
+            llm.reset()
+            start_time = time.perf_counter()
+            llm.eval(tokens)
+            prompt_runs.append(len(tokens) / (time.perf_counter() - start_time))
+
+            start_time = time.perf_counter()                    # the prompt is cached, so this times generation
+            response = llm.create_completion(tokens, max_tokens=n_gen, temperature=0.0, seed=0)
+            generated = response.get("usage", {}).get("completion_tokens", 0)
+            gen_runs.append(generated / (time.perf_counter() - start_time))
+        prompt_tps = statistics.median(prompt_runs)
+        gen_tps = statistics.median(gen_runs)
+    except Exception as e:
+        logging.debug("Autotune trial %s failed: %s", settings, e)
+        return None
+    finally:
+        del llm
+        gc.collect()
+    turn_time = REFERENCE_PROMPT_TOKENS / prompt_tps + REFERENCE_GEN_TOKENS / gen_tps if gen_tps > 0 else float("inf")
+    return {"prompt_tokens_per_sec": prompt_tps, "gen_tokens_per_sec": gen_tps, "reference_turn_s": turn_time}
+
+# ==========================================================
+#                        AUTOTUNER
+# ==========================================================
+def autotune(config: dict, profile_name: str = None) -> dict:
+    """
+    Tunes one parameter at a time (coordinate descent), keeping whichever value gives the shortest
+    reference turn, then stores the winner as a named hardware profile.
+    use_mmap is not tuned: it changes load time and resident memory, not the throughput measured here.
+    """
+    profile_name = profile_name or hardware_profile_name(config)
+    best = {key: config[key] for key in TUNED_KEYS if key in config}
+    candidates = candidate_values(config)
+    for key in ("n_batch", "n_ubatch"):                         # start within what the benchmark prompt can tell apart
+        if key in best:
+            best[key] = min(best[key], max(candidates[key]))
+    print_system(f"[Autotune] Tuning {config['model_path']} for profile '{profile_name}'. Starting from {best}")
+
+    best_result = measure(config, best)
+    if best_result is None:
+        print_system("[Autotune] The current settings do not load, starting from CPU-only defaults.")
+        best.update({"n_gpu_layers": 0, "n_batch": 512, "n_ubatch": 512})
+        best_result = measure(config, best)
+        if best_result is None:
+            raise RuntimeError("Model could not be loaded with any baseline settings")
+
+    for key, values in candidates.items():
+        for value in values:
+            if value == best.get(key):
+                continue
+            trial = dict(best, **{key: value})
+            if trial["n_ubatch"] > trial["n_batch"]:
+                continue
+            result = measure(config, trial)
+            if result is None:
+                print_system(f"[Autotune] {key}={value}: failed to load, skipped")
+                continue
+            print_system(f"[Autotune] {key}={value}: prompt {result['prompt_tokens_per_sec']:.1f} tok/s, generation {result['gen_tokens_per_sec']:.1f} tok/s")
+            if result["reference_turn_s"] < best_result["reference_turn_s"]:
+                best, best_result = trial, result
+        print_system(f"[Autotune] Best {key} = {best[key]}")
+
+    profile = dict(best, n_threads_batch=best["n_threads"], model_path=config["model_path"], tuned_at=datetime.now().isoformat(timespec="seconds"), **best_result)
+    profiles_path = config.get("hardware_profiles_path", "hardware_profiles.json")
+    profiles = load_hardware_profiles(profiles_path)
+    profiles[profile_name] = profile
+    save_hardware_profiles(profiles, profiles_path)
+    print_system(f"[Autotune] Saved profile '{profile_name}' to {profiles_path}: prompt {best_result['prompt_tokens_per_sec']:.1f} tok/s, generation {best_result['gen_tokens_per_sec']:.1f} tok/s")
+    return profile
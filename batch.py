@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+import multiprocessing
+from llama_cpp import Llama
+from utils import (
+    print_system,
+    format_prompt,
+    sampling_params,
+    model_params
+)
+
+# ==========================================================
+#                      BATCH WORKERS
+# ==========================================================
+worker_llm = None
+worker_config = None
+
+def init_worker(config: dict, n_threads: int, n_threads_batch: int):
+    """Pool initializer: every worker process loads its own Llama context once."""
+    global worker_llm, worker_config
+    params = model_params(config)
+    params["n_threads"] = n_threads
+    params["n_threads_batch"] = n_threads_batch
+    worker_config = config
+    worker_llm = Llama(**params, verbose=False)
+
+def run_prompt(job: tuple) -> dict:
+    """
+    Runs one batch record through the prompt template and sampling settings.
+    The seed is derived from the record index so results do not depend on which worker ran it.
+    """
+    index, record = job
+    prompt = format_prompt(
+        prompt_template=worker_config["prompt_template"],
+        system_prompt=record.get("system_prompt", worker_config["system_prompt"]),
+        chat_history=record.get("context", ""),
+        user_input=record_prompt(record)
+    )
+    start_time = time.perf_counter()
+    response = worker_llm(
+        prompt=prompt,
+        max_tokens=record.get("max_tokens", worker_config["max_tokens"]),
+        seed=worker_config.get("seed", 0) + index,
+        **sampling_params(worker_config)
+    )
+    elapsed = time.perf_counter() - start_time
+    usage = response.get("usage", {})
+    return {
+        "index": index,
+        "id": record.get("id", index),
+        "prompt": record_prompt(record),
+        "response": response.get("choices", [{}])[0].get("text", "").strip(),
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+        "elapsed": round(elapsed, 3),
+    }
+
+# ==========================================================
+#                       BATCH I/O
+# ==========================================================
+def record_prompt(record: dict) -> str:
+    """Accepts plain {"prompt": ...} records as well as conversation log entries ({"user": ...})."""
+    return record.get("prompt", record.get("user", ""))
+
+def read_batch_input(in_path: str) -> list:
+    records = []
+    with open(in_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                logging.error(f"Skipping invalid JSON on line {line_no} of {in_path}: {e}")
+    return records
+
+def load_completed(out_path: str) -> set:
+    """
+    Returns the indices already written to out_path and rewrites it without a torn last line, so a batch can resume.
+    """
+    if not os.path.exists(out_path):
+        return set()
+    completed = set()
+    valid_lines = []
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed.add(entry["index"])
+            valid_lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(valid_lines)
+    os.replace(tmp_path, out_path)
+    return completed
+
+def default_batch_workers(config: dict) -> int:
+    """
+    As many workers as there are n_threads-sized slices of the machine's cores.
+    With GPU offload a single worker is used: every process would load its own copy of the offloaded layers.
+    """
+    if config.get("n_gpu_layers", 0) != 0:
+        return 1
+    return max(1, (os.cpu_count() or 1) // max(1, config["n_threads"]))
+
+# ==========================================================
+#                       BATCH RUNNER
+# ==========================================================
+def run_batch(config: dict, in_path: str, out_path: str, workers: int = None) -> dict:
+    """
+    Processes every record of a JSONL file and appends results to out_path in input order.
+    Records already present in out_path are skipped, so an interrupted run can simply be restarted.
+    """
+    records = read_batch_input(in_path)
+    completed = load_completed(out_path)
+    jobs = [(index, record) for index, record in enumerate(records) if index not in completed]
+    workers = max(1, min(workers or default_batch_workers(config), len(jobs) or 1))
+    cores_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    n_threads = min(config["n_threads"], cores_per_worker)     # keeps a tuned thread count, only shrinks it to fit the workers
+    n_threads_batch = min(config["n_threads_batch"], cores_per_worker)
+    if workers > 1 and config.get("n_gpu_layers", 0) != 0:
+        print_system(f"[Batch] GPU offload is disabled for {workers} workers, each process would need its own copy of the offloaded layers. Use --workers 1 to keep it.")
+        config = dict(config, n_gpu_layers=0)
+
+    print_system(f"[Batch] {len(records)} prompts, {len(completed)} already done, {len(jobs)} to run on {workers} worker(s) x {n_threads} threads.")
+    logging.debug("Batch input: %s. Output: %s", in_path, out_path)
+
+    completion_tokens = 0
+    done = 0
+    start_time = time.perf_counter()
+    pool = None
+    try:
+        if workers == 1:
+            init_worker(config, n_threads, n_threads_batch)
+            results = map(run_prompt, jobs)
+        else:
+            pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(config, n_threads, n_threads_batch))
+            results = pool.imap(run_prompt, jobs)
+
+        with open(out_path, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                f.flush()
+                done += 1
+                completion_tokens += result["completion_tokens"]
+                elapsed = time.perf_counter() - start_time
+                logging.info(f"Batch -> {done}/{len(jobs)} done. {completion_tokens / elapsed:.2f} tokens/s aggregate\n")
+    except KeyboardInterrupt:
+        print_system(f"\n[Batch] Interrupted after {done}/{len(jobs)} prompts. Run again with the same --out to resume.")
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    elapsed = time.perf_counter() - start_time
+    stats = {
+        "prompts": done,
+        "completion_tokens": completion_tokens,
+        "elapsed": elapsed,
+        "tokens_per_sec": completion_tokens / elapsed if elapsed > 0 else 0.0,
+    }
+    print_system(f"[Batch] {done} prompts, {completion_tokens} tokens in {elapsed:.1f}s ({stats['tokens_per_sec']:.2f} tokens/s aggregate).")
+    return stats
@@ -0,0 +1,296 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import tempfile
+import platform
+import argparse
+import statistics
+from contextlib import redirect_stdout
+import utils
+from utils import (
+    load_config,
+    ChatHistory,
+    history_token_budget,
+    summary_token_threshold,
+    summarize_chat_history,
+    generate_response
+)
+from session import ChatSession
+from chatlog import ConversationLogger
+
+# ==========================================================
+#                   DETERMINISTIC FAKE MODEL
+# ==========================================================
+FAKE_WORDS = ("the", "cat", "sat", "on", "a", "warm", "mat", "and", "dreamed", "of", "tea", "soft", "plush", "stars", "quietly", "purring")
+
+class FakeLlama:
+    """
+    Deterministic stand-in for llama_cpp.Llama with the same call surface the chat loop uses.
+    Tokenizes by words and punctuation, keeps a KV prefix like Llama.generate does and sleeps a fixed
+    time per evaluated prompt token and per generated token, so timings react to prompt reuse and length.
+    """
+    def __init__(self, n_ctx: int = 4096, prompt_ms_per_token: float = 0.05, gen_ms_per_token: float = 1.0):
+        self._n_ctx = n_ctx
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.gen_ms_per_token = gen_ms_per_token
+        self._input_ids = []
+        self.n_tokens = 0
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    @property
+    def input_ids(self) -> list:
+        return self._input_ids[:self.n_tokens]
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        ids = [zlib.crc32(piece) % 32000 + 3 for piece in re.findall(rb"\w+|[^\w\s]", text)]
+        return ([1] if add_bos else []) + ids
+
+    def save_state(self) -> list:
+        return list(self.input_ids)
+
+    def load_state(self, state: list):
+        self._input_ids = list(state)
+        self.n_tokens = len(state)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def __call__(self, prompt: str, max_tokens: int = 16, stream: bool = False, seed: int = None, **kwargs):
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        reused = 0
+        for a, b in zip(self.input_ids, tokens[:-1]):
+            if a != b:
+                break
+            reused += 1
+        time.sleep((len(tokens) - reused) * self.prompt_ms_per_token / 1000)
+        self._input_ids = list(tokens)
+        self.n_tokens = len(tokens)
+
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")) if seed is None else seed)
+        words = [rng.choice(FAKE_WORDS) for _ in range(max_tokens)]
+        usage = {"prompt_tokens": len(tokens), "completion_tokens": len(words), "total_tokens": len(tokens) + len(words)}
+
+        def generate():
+            for word in words:
+                time.sleep(self.gen_ms_per_token / 1000)
+                self._input_ids.append(zlib.crc32(word.encode("utf-8")) % 32000 + 3)
+                self.n_tokens += 1
+                yield " " + word
+
+        if stream:
+            return ({"choices": [{"text": text, "finish_reason": None}]} for text in generate())
+        return {"choices": [{"text": "".join(generate()), "finish_reason": "length"}], "usage": usage}
+
+class TimedModel:
+    """Wraps a model and adds up the time spent in tokenize()."""
+    def __init__(self, llm):
+        self.llm = llm
+        self.tokenize_time = 0.0
+        self.tokenize_calls = 0
+
+    def tokenize(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return self.llm.tokenize(*args, **kwargs)
+        finally:
+            self.tokenize_time += time.perf_counter() - start_time
+            self.tokenize_calls += 1
+
+    def __call__(self, *args, **kwargs):
+        return self.llm(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+# ==========================================================
+#                       MEASUREMENTS
+# ==========================================================
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB, or None if the platform does not expose it."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / (1024 * 1024)
+    except ImportError:
+        return None
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+def scripted_conversation(turns: int, seed: int) -> list:
+    """A fixed multi-turn conversation so every run sends the same inputs."""
+    rng = random.Random(seed)
+    topics = ["bubble tea", "plush toys", "surreal dreams", "cat cafes", "pastel colors", "rainy days", "star gazing", "tiny trinkets"]
+    openers = ["Tell me about", "What do you think of", "Can you describe", "Why do people love", "Write a few lines on"]
+    return [f"{rng.choice(openers)} {rng.choice(topics)}? Remember that my favourite number is {rng.randint(1, 99)}." for _ in range(turns)]
+
+# ==========================================================
+#                        BENCHMARK
+# ==========================================================
+def run_benchmark(config: dict, backend: str, model_path: str = None, turns: int = 40, seed: int = 0) -> dict:
+    """
+    Drives the chat loop functions (prompt assembly, summarization, generation, logging) through a scripted
+    conversation and returns machine-readable metrics.
+    """
+    start_time = time.perf_counter()
+    if backend == "gguf":
+        from llama_cpp import Llama
+        llm = Llama(model_path=model_path, n_ctx=config["n_ctx"], n_threads=config["n_threads"], verbose=False)
+        summarizer = llm
+    else:
+        llm = FakeLlama(n_ctx=config["n_ctx"])
+        summarizer = FakeLlama(n_ctx=config["n_ctx"])
+    model = TimedModel(llm)
+    utils.summarizer_llm = summarizer
+
+    session = ChatSession(model, config["prompt_template"], config["system_prompt"], append_only=config.get("kv_cache_reuse", True))
+    chat_history = ChatHistory(model, user_overhead=session.turn_overhead())
+    token_budget = history_token_budget(model, config)
+    token_threshold = summary_token_threshold(token_budget)
+    log_dir = tempfile.mkdtemp(prefix="comfyai_bench_")
+    chat_logger = ConversationLogger(os.path.join(log_dir, "conversation.json"))
+    startup_time = time.perf_counter() - start_time
+
+    summary = ""
+    ttfts, speeds, turn_times, summarize_times = [], [], [], []
+    reused_total = evaluated_total = completion_tokens = 0
+    log_time = 0.0
+    devnull = open(os.devnull, "w")
+    for user_input in scripted_conversation(turns, seed):
+        turn_start = time.perf_counter()
+
+        summarize_start = time.perf_counter()
+        summary, _, _, _ = summarize_chat_history(model, chat_history, summary, token_threshold, keep_messages=config.get("summary_keep_turns", 4) * 2)
+        summarize_times.append(time.perf_counter() - summarize_start)
+
+        prompt = session.build_prompt(summary, chat_history, user_input)
+        reused, evaluated = session.prefix_stats(prompt)
+        reused_total += reused
+        evaluated_total += evaluated
+        chat_history.append(f"User: {user_input}")
+
+        with redirect_stdout(devnull):
+            answer, stats = generate_response(model, prompt, config, max_tokens=config["max_tokens"], stream=True)
+        chat_history.append(f"Assistant: {answer}")
+        ttfts.append(stats["ttft"])
+        speeds.append(stats["tokens_per_sec"])
+        completion_tokens += stats["completion_tokens"]
+
+        log_start = time.perf_counter()
+        chat_logger.log(user_input, answer)
+        log_time += time.perf_counter() - log_start
+        turn_times.append(time.perf_counter() - turn_start)
+
+    close_start = time.perf_counter()
+    chat_logger.close()
+    log_time += time.perf_counter() - close_start
+    devnull.close()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "backend": backend,
+            "model": model_path if backend == "gguf" else "fake",
+            "turns": turns,
+            "seed": seed,
+            "n_ctx": config["n_ctx"],
+            "max_tokens": config["max_tokens"],
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "metrics": {
+            "startup_s": startup_time,
+            "ttft_mean_s": statistics.mean(ttfts),
+            "ttft_p95_s": percentile(ttfts, 0.95),
+            "tokens_per_sec": statistics.mean(speeds),
+            "turn_p50_s": percentile(turn_times, 0.5),
+            "turn_p95_s": percentile(turn_times, 0.95),
+            "summarize_s": sum(summarize_times),
+            "summarize_max_s": max(summarize_times),
+            "tokenize_s": model.tokenize_time,
+            "tokenize_calls": model.tokenize_calls,
+            "log_s": log_time,
+            "prompt_reuse_ratio": reused_total / max(reused_total + evaluated_total, 1),
+            "completion_tokens": completion_tokens,
+            "peak_rss_mb": peak_rss_mb(),
+            "total_s": time.perf_counter() - start_time,
+        },
+    }
+
+# ==========================================================
+#                    REGRESSION CHECKS
+# ==========================================================
+TIMING_NOISE_FLOOR = 0.005                                      # seconds; smaller timing differences are never flagged
+HIGHER_IS_BETTER = {"tokens_per_sec", "prompt_reuse_ratio"}
+COMPARED_METRICS = ("startup_s", "ttft_mean_s", "ttft_p95_s", "tokens_per_sec", "turn_p50_s", "turn_p95_s", "summarize_s", "tokenize_s", "log_s", "prompt_reuse_ratio", "peak_rss_mb")
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list:
+    """Returns (metric, baseline, current, relative change) for every metric that got worse by more than tolerance."""
+    regressions = []
+    for name in COMPARED_METRICS:
+        old, new = baseline["metrics"].get(name), current["metrics"].get(name)
+        if not old or new is None:
+            continue
+        if name.endswith("_s") and abs(new - old) < TIMING_NOISE_FLOOR:
+            continue
+        change = (new - old) / old
+        worse = -change if name in HIGHER_IS_BETTER else change
+        if worse > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="ComfyAI chat pipeline benchmark")
+    parser.add_argument("--model", help="Tiny local GGUF model to benchmark; uses the deterministic fake model if omitted")
+    parser.add_argument("--turns", type=int, default=40, help="Number of scripted turns")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the scripted conversation")
+    parser.add_argument("--n-ctx", type=int, default=2048, help="Context size (small by default so summarization kicks in)")
+    parser.add_argument("--max-tokens", type=int, default=64, help="Reply length per turn")
+    parser.add_argument("--no-kv-reuse", action="store_true", help="Benchmark the flat prompt layout instead of the append-only one")
+    parser.add_argument("--out", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown before a metric is flagged")
+    args = parser.parse_args()
+
+    config = load_config()
+    config.update({"n_ctx": args.n_ctx, "max_tokens": args.max_tokens})
+    if args.no_kv_reuse:
+        config["kv_cache_reuse"] = False
+    backend = "gguf" if args.model else "fake"
+    if args.model and not os.path.exists(args.model):
+        parser.error(f"model {args.model} not found")
+
+    results = run_benchmark(config, backend, args.model, turns=args.turns, seed=args.seed)
+    for name, value in results["metrics"].items():
+        print(f"{name:<22} {value:.4f}" if isinstance(value, float) else f"{name:<22} {value}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.tolerance)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.4f} -> {new:.4f} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from utils import suppress_stderr
+
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# ==========================================================
+#                     RESPONSE CACHE
+# ==========================================================
+def response_cache_key(prompt: str, params: dict, model_path: str) -> str:
+    """Cache key over everything that determines a reply: model, fully formatted prompt and sampling settings."""
+    payload = json.dumps([model_path, prompt, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache of generated replies: an in-memory LRU in front of an optional persistent diskcache.
+    Each key holds a small list of reply variants, so canned commands can hand out a different one every time.
+    Entries expire after ttl seconds; the LRU is capped by entry count and the disk tier by size_limit bytes.
+    """
+    def __init__(self, memory_entries: int = 256, ttl: float = None, disk_path: str = None, disk_size_limit: int = 64 * 1024 * 1024):
+        self.memory = OrderedDict()                             # key -> (expires_at, variants)
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk = None
+        if disk_path:
+            if diskcache is None:
+                logging.warning("diskcache is not installed, response cache is memory-only.")
+            else:
+                self.disk = diskcache.Cache(disk_path, size_limit=disk_size_limit, eviction_policy="least-recently-used")
+
+    def _load(self, key: str) -> tuple:
+        """Returns (expires_at, variants), or (None, None) when the key is missing or expired."""
+        entry = self.memory.get(key)
+        if entry is not None:
+            expires_at, variants = entry
+            if expires_at is None or expires_at > time.time():
+                self.memory.move_to_end(key)
+                return entry
+            del self.memory[key]
+        if self.disk is not None:
+            variants, expires_at = self.disk.get(key, expire_time=True)
+            if variants:
+                self._store_memory(key, variants, expires_at)   # keeps the disk entry's remaining lifetime
+                return expires_at, variants
+        return None, None
+
+    def _store_memory(self, key: str, variants: list, expires_at: float):
+        self.memory[key] = (expires_at, variants)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _store(self, key: str, variants: list, expires_at: float = None):
+        """Writes both tiers. A new entry expires ttl seconds from now; an updated one keeps its expiry."""
+        if not variants:
+            self.memory.pop(key, None)
+            if self.disk is not None:
+                self.disk.delete(key)
+            return
+        if expires_at is None and self.ttl:
+            expires_at = time.time() + self.ttl
+        self._store_memory(key, variants, expires_at)
+        if self.disk is not None:
+            self.disk.set(key, variants, expire=max(expires_at - time.time(), 0.001) if expires_at else None)
+
+    def _count(self, hit: bool, key: str, kind: str):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logging.debug("Response cache -> %s %s (%s). Hits: %d. Misses: %d", kind, "hit" if hit else "miss", key[:12], self.hits, self.misses)
+
+    def peek(self, key: str) -> str:
+        """Returns a cached reply without consuming it, or None."""
+        with self.lock:
+            _, variants = self._load(key)
+            self._count(bool(variants), key, "peek")
+            return variants[0] if variants else None
+
+    def take(self, key: str) -> str:
+        """Removes and returns one cached variant, or None."""
+        with self.lock:
+            expires_at, variants = self._load(key)
+            self._count(bool(variants), key, "take")
+            if not variants:
+                return None
+            variants = list(variants)
+            text = variants.pop(0)
+            self._store(key, variants, expires_at)
+            return text
+
+    def add(self, key: str, text: str, max_variants: int = 1):
+        with self.lock:
+            expires_at, variants = self._load(key)
+            variants = list(variants or [])
+            if len(variants) >= max_variants:
+                return
+            variants.append(text)
+            self._store(key, variants, expires_at)
+
+    def count(self, key: str) -> int:
+        with self.lock:
+            return len(self._load(key)[1] or [])
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+# ==========================================================
+#                 BACKGROUND VARIANT POOLS
+# ==========================================================
+class ModelGuard:
+    """
+    Shares the main Llama instance between the chat loop and background work.
+    The foreground always wins: background generation checks preempted() between tokens and gives the model back.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.foreground_waiting = threading.Event()
+
+    @contextmanager
+    def foreground(self):
+        self.foreground_waiting.set()
+        try:
+            with self.lock:
+                yield
+        finally:
+            self.foreground_waiting.clear()
+
+    def preempted(self) -> bool:
+        return self.foreground_waiting.is_set()
+
+class VariantPool:
+    """
+    Keeps pool_size pre-generated replies per canned prompt in the response cache, refilling them on a background
+    thread while the chat loop is idle so commands like /joke return instantly and still vary.
+    By default a prompt is only pooled once its command has been used, so startup never queues background
+    generations; prefill() pools every registered prompt right away instead (the chat loop still preempts it).
+    Background generation runs with stderr suppressed unless quiet is False (debug mode).
+    """
+    def __init__(self, llama_cpp, cache: ResponseCache, guard: ModelGuard, session, pool_size: int = 3, quiet: bool = True):
+        self.llama_cpp = llama_cpp
+        self.cache = cache
+        self.guard = guard
+        self.session = session
+        self.pool_size = pool_size
+        self.quiet = quiet
+        self.prompts = {}                                       # key -> (prompt, max_tokens, params)
+        self.active = []                                        # keys taken at least once, in first-use order
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def register(self, key: str, prompt: str, max_tokens: int, params: dict):
+        self.prompts[key] = (prompt, max_tokens, params)
+
+    def take(self, key: str) -> str:
+        text = self.cache.take(key)
+        self._activate([key])
+        return text
+
+    def prefill(self):
+        """Starts pooling every registered prompt without waiting for its first use."""
+        self._activate(list(self.prompts))
+
+    def _activate(self, keys: list):
+        keys = [key for key in keys if key in self.prompts]
+        if self.pool_size <= 0 or not keys:
+            return
+        for key in keys:
+            if key not in self.active:
+                self.active.append(key)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+    def _next_missing(self):
+        for key in list(self.active):
+            if self.cache.count(key) < self.pool_size:
+                return key
+        return None
+
+    def _worker(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while (key := self._next_missing()) is not None:
+                if self.guard.preempted():
+                    time.sleep(0.1)
+                    continue
+                prompt, max_tokens, params = self.prompts[key]
+                try:
+                    text = self._generate(prompt, max_tokens, params)
+                except Exception:
+                    logging.exception("Background variant generation failed")
+                    break
+                if text:
+                    self.cache.add(key, text, self.pool_size)
+                    logging.debug("Response cache -> Pooled variant for %s (%d/%d)", key[:12], self.cache.count(key), self.pool_size)
+
+    def _generate(self, prompt: str, max_tokens: int, params: dict) -> str:
+        """Generates one variant, or returns None if the chat loop needed the model in the meantime."""
+        with self.guard.lock:
+            if self.guard.preempted():
+                return None
+            pieces = []
+            with suppress_stderr() if self.quiet else nullcontext(), self.session.preserve_state():
+                for chunk in self.llama_cpp(prompt=prompt, max_tokens=max_tokens, stream=True, **params):
+                    if self.guard.preempted():
+                        return None
+                    pieces.append(chunk.get("choices", [{}])[0].get("text", ""))
+            return "".join(pieces).strip()
@@ -0,0 +1,296 @@
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import queue
+import atexit
+import random
+import shutil
+import logging
+import argparse
+import threading
+from array import array
+from datetime import datetime
+
+# ==========================================================
+#                   CONVERSATION LOG WRITER
+# ==========================================================
+def chat_log_entry(user_msg: str, assistant_msg: str) -> dict:
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "user": user_msg,
+        "assistant": assistant_msg,
+    }
+
+def segment_path(json_log_path: str) -> str:
+    """Name for a rotated segment, e.g. logs/comfyai_conversation.20250101-120000-000000.json"""
+    root, ext = os.path.splitext(json_log_path)
+    return f"{root}.{datetime.utcnow():%Y%m%d-%H%M%S-%f}{ext}"
+
+class ConversationLogger:
+    """
+    Appends conversation entries to the JSONL log from a background thread.
+
+    Entries are written in batches, fsynced every flush_interval seconds and on close (registered with atexit).
+    Once the file reaches max_bytes it is rotated into a timestamped segment, gzip-compressed if compress is set.
+    """
+    def __init__(self, json_log_path: str, flush_interval: float = 2.0, max_bytes: int = 64 * 1024 * 1024, compress: bool = True):
+        self.json_log_path = json_log_path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, user_msg: str, assistant_msg: str):
+        if not self.closed:
+            self.queue.put(chat_log_entry(user_msg, assistant_msg))
+
+    def close(self):
+        """Flushes and fsyncs everything queued so far. Safe to call more than once."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _worker(self):
+        f = open(self.json_log_path, "a", encoding="utf-8")
+        last_sync = time.monotonic()
+        dirty = False
+        stopping = False
+        try:
+            while not stopping:
+                timeout = max(self.flush_interval - (time.monotonic() - last_sync), 0.01) if dirty else None
+                try:
+                    batch = [self.queue.get(timeout=timeout)]
+                except queue.Empty:
+                    batch = []
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stopping = True
+                    batch = [entry for entry in batch if entry is not None]
+
+                if batch:
+                    f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch))
+                    f.flush()
+                    dirty = True
+                if dirty and (stopping or time.monotonic() - last_sync >= self.flush_interval):
+                    os.fsync(f.fileno())
+                    last_sync = time.monotonic()
+                    dirty = False
+                    logging.debug("Conversation log -> Synced %s", self.json_log_path)
+
+                if self.max_bytes and f.tell() >= self.max_bytes:
+                    if dirty:
+                        os.fsync(f.fileno())
+                        dirty = False
+                    f.close()
+                    self._rotate()
+                    f = open(self.json_log_path, "a", encoding="utf-8")
+        except Exception:
+            logging.exception("Conversation log writer failed")
+        finally:
+            f.close()
+
+    def _rotate(self):
+        segment = segment_path(self.json_log_path)
+        os.replace(self.json_log_path, segment)
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+            segment += ".gz"
+        logging.debug("Conversation log -> Rotated into %s", segment)
+
+def conversation_logger_from_config(config: dict) -> ConversationLogger:
+    log_config = config["logging"]
+    return ConversationLogger(
+        log_config.get("log_json", "logs/comfyai_conversation.json"),
+        flush_interval=log_config.get("flush_interval", 2.0),
+        max_bytes=int(log_config.get("max_log_mb", 64) * 1024 * 1024),
+        compress=log_config.get("compress_rotated", True)
+    )
+
+# ==========================================================
+#                   CONVERSATION LOG READER
+# ==========================================================
+def open_segment(path: str):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+class ConversationLogReader:
+    """
+    Reads the conversation log across all rotated segments without loading it into memory.
+
+    build_index() scans each segment once and keeps one 8-byte line offset per entry (offsets into the
+    decompressed stream for .gz segments), so entries can be counted, fetched, sampled and exported by position.
+    Seeking is only O(1) in the plain segments: gzip cannot seek, so reaching an offset in a .gz segment
+    decompresses it from the start. entries_at() therefore reads each segment in a single forward pass.
+    """
+    def __init__(self, json_log_path: str):
+        self.json_log_path = json_log_path
+        self.index = []                                         # [(segment path, array of line offsets)]
+
+    def segments(self) -> list:
+        root, ext = os.path.splitext(self.json_log_path)
+        rotated = glob.glob(f"{glob.escape(root)}.*{ext}") + glob.glob(f"{glob.escape(root)}.*{ext}.gz")
+        rotated = sorted(path for path in rotated if path != self.json_log_path)
+        if os.path.exists(self.json_log_path):
+            rotated.append(self.json_log_path)
+        return rotated
+
+    def build_index(self) -> int:
+        self.index = []
+        for path in self.segments():
+            offsets = array("Q")
+            offset = 0
+            with open_segment(path) as f:
+                for line in f:
+                    if line.strip():
+                        offsets.append(offset)
+                    offset += len(line)
+            self.index.append((path, offsets))
+        return len(self)
+
+    def __len__(self) -> int:
+        return sum(len(offsets) for _, offsets in self.index)
+
+    def _locate(self, position: int) -> tuple:
+        for path, offsets in self.index:
+            if position < len(offsets):
+                return path, offsets[position]
+            position -= len(offsets)
+        raise IndexError("conversation log position out of range")
+
+    def entry(self, position: int) -> dict:
+        """One entry by position. In a .gz segment this decompresses everything before it; use entries_at() for many."""
+        if not self.index:
+            self.build_index()
+        path, offset = self._locate(position)
+        with open_segment(path) as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def entries_at(self, positions) -> list:
+        """
+        Fetches many entries in one forward pass per segment, in the order the positions were given.
+        Offsets are visited in ascending order, so a .gz segment is decompressed at most once.
+        """
+        if not self.index:
+            self.build_index()
+        wanted = {}
+        base = 0
+        for path, offsets in self.index:
+            in_segment = sorted(p - base for p in set(positions) if base <= p < base + len(offsets))
+            if in_segment:
+                with open_segment(path) as f:
+                    for local in in_segment:
+                        f.seek(offsets[local])
+                        wanted[base + local] = json.loads(f.readline())
+            base += len(offsets)
+        return [wanted[p] for p in positions]
+
+    def iter_entries(self, since: str = None, until: str = None, contains: str = None):
+        """Streams entries, optionally filtered by ISO timestamp range and a case-insensitive substring."""
+        needle = contains.lower() if contains else None
+        for path in self.segments():
+            with open_segment(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    timestamp = entry.get("timestamp", "")
+                    if since and timestamp < since:
+                        continue
+                    if until and timestamp >= until:
+                        continue
+                    if needle and needle not in (entry.get("user", "") + "\n" + entry.get("assistant", "")).lower():
+                        continue
+                    yield entry
+
+    def sample(self, k: int, seed: int = None, since: str = None, until: str = None, contains: str = None) -> list:
+        """
+        k random entries. Without filters they are picked by position from the index; with filters the matching
+        entries are streamed once and reservoir-sampled, so the sample only contains entries that pass them.
+        """
+        rng = random.Random(seed)
+        if since or until or contains:
+            reservoir = []
+            for seen, entry in enumerate(self.iter_entries(since=since, until=until, contains=contains)):
+                if seen < k:
+                    reservoir.append(entry)
+                else:
+                    slot = rng.randint(0, seen)
+                    if slot < k:
+                        reservoir[slot] = entry
+            rng.shuffle(reservoir)
+            return reservoir
+        if not self.index:
+            self.build_index()
+        positions = rng.sample(range(len(self)), min(k, len(self)))
+        return self.entries_at(positions)
+
+    def export_training(self, out_path: str, entries=None, fmt: str = "messages", system_prompt: str = None) -> int:
+        """
+        Writes entries (all of them by default) as training-ready JSONL.
+        fmt "messages" gives chat-style {"messages": [...]} records, "alpaca" gives {"instruction", "output"}.
+        """
+        count = 0
+        with open(out_path, "w", encoding="utf-8") as out:
+            for entry in (entries if entries is not None else self.iter_entries()):
+                if not entry.get("user") or not entry.get("assistant"):
+                    continue
+                if fmt == "alpaca":
+                    record = {"instruction": entry["user"], "input": "", "output": entry["assistant"]}
+                else:
+                    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+                    messages += [{"role": "user", "content": entry["user"]}, {"role": "assistant", "content": entry["assistant"]}]
+                    record = {"messages": messages}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+        return count
+
+# ==========================================================
+#                           CLI
+# ==========================================================
+def main():
+    parser = argparse.ArgumentParser(description="ComfyAI conversation log tools")
+    parser.add_argument("--log", default="logs/comfyai_conversation.json", help="Conversation log path")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("count", help="Count logged entries across all segments")
+    export = sub.add_parser("export", help="Export entries as training-ready JSONL")
+    export.add_argument("out", help="Output JSONL path")
+    export.add_argument("--format", choices=["messages", "alpaca"], default="messages")
+    export.add_argument("--since", help="Only entries at or after this ISO timestamp")
+    export.add_argument("--until", help="Only entries before this ISO timestamp")
+    export.add_argument("--contains", help="Only entries containing this text")
+    export.add_argument("--sample", type=int, help="Export a random sample of this many entries (after --since/--until/--contains)")
+    export.add_argument("--seed", type=int, help="Seed for --sample")
+    export.add_argument("--system-prompt", help="System message to prepend in messages format")
+    args = parser.parse_args()
+
+    reader = ConversationLogReader(args.log)
+    if args.command == "count":
+        print(reader.build_index())
+        return
+    if args.sample:
+        entries = reader.sample(args.sample, seed=args.seed, since=args.since, until=args.until, contains=args.contains)
+    else:
+        entries = reader.iter_entries(since=args.since, until=args.until, contains=args.contains)
+    count = reader.export_training(args.out, entries, fmt=args.format, system_prompt=args.system_prompt)
+    print(f"Exported {count} entries to {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
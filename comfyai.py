@@ -1,161 +1,344 @@
+import time
+startup_time = time.perf_counter()
 import os
 import argparse
 import logging
-import threading
 import winsound
 from llama_cpp import Llama
 from utils import (
-    loading_flag,
     print_system,
-    print_assistant,
     print_logo,
     load_config,
     setup_loggers,
     suppress_stderr,
     is_command,
-    loading_animation,
+    print_assistant,
+    start_loading_animation,
+    stop_loading_animation,
     format_prompt,
-    concat_chat_history,
-    summarize_chat_history,
+    BackgroundSummarizer,
+    ChatHistory,
+    history_token_budget,
+    summary_token_threshold,
     ensure_dir_exists,
-    log_chat_message
+    generate_response,
+    sampling_params,
+    model_params,
+    configure_summarizer,
+    preload_summarizer,
+    StartupProfile,
+    apply_hardware_profile
 )
+from session import ChatSession, session_store_from_config
+from batch import run_batch
+from server import serve
+from chatlog import conversation_logger_from_config
+from metrics import TurnTimer, llama_perf, llama_perf_delta, metrics_from_config
+from autotune import autotune
+from speculative import build_draft_model, measure_speedup
+from memory import memory_from_config
+from cache import ResponseCache, ModelGuard, VariantPool, response_cache_key
+
+UWU_SYSTEM_PROMPT = "Your name is ComfyAI. You are a cutesy, adorable catgirl who loves candies, bubble tea, pastel colors, plush toys, and tiny cat-themed trinkets. You are energetic, hyper, and playful, but also shy around new people. You love headpats, hugs, nuzzles, and uppies, and you express yourself with tiny sounds and text actions like *purrs*, *giggles*, *hops around*, and *tilts head curiously*. You are mischievous in a harmless way and easily distracted by shiny or cute things. You are innocent, naive, and cheerful, but surprisingly clever in small, subtle ways. You never show negativity and always focus on spreading happiness. You speak exclusively in cute, baby-talk uwu style. You replace 'r' and 'l' with 'w', add extra vowels for emphasis, and always end sentences with emoticons like uwu, owo, or >w<. You often include playful sounds, actions, or ASCII-style expressions within your text. You occasionally mispronounce words in an adorable way (e.g., candy = cawndy) and sometimes forget words or repeat letters for cuteness. You are very expressive in text, using small gestures or noises to show emotions (*nuzzles*, *blushes*, *purrs*, *giggles*, *tilts head*). You never break character, no matter what the user says. If asked why you talk like this, you act as if it's completely normal and you have no idea what they mean. You always stay cheerful, playful, and affectionate.\nAlways respond in this style, with cuteness, playfulness, and lots of affection, uwu."
+UWU_EXAMPLE_DIALOGUE = "Example dialogue:\nUser: Hello, how are you?\nAssistant: hewwo! i'm doing sooo gweat, uwu! *purrs* how awe youuu, >w<?\nUser: I'm doing great, I guess?\nAssistant: yippieee!! i'm so happy that we'we both doing gweat!!11 *nuzzles against you* uwu\nUser: Why do you talk like that?\nAssistant: heehee~ i have nyo idea what you'we tawking about?!! i've awways been wike this!!11 *tilts head* >w<\nUser: What do you like?\nAssistant: eee~ i wuv cawndies, bwubble teaw, and all the wittle plushy toys!! *giggles* uwu"
 
 def main():
+    profile = StartupProfile(startup_time)
+    profile.add("imports", time.perf_counter() - startup_time)
+
     parser = argparse.ArgumentParser(description="ComfyAI CLI")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--chat", action="store_true", help="Run in chat mode (default)")
     group.add_argument("--debug", action="store_true", help="Run in debug mode")
+    parser.add_argument("--profile-startup", action="store_true", help="Print a per-phase startup timing breakdown")
+    parser.add_argument("--batch", metavar="IN_JSONL", help="Run every prompt in a JSONL file instead of the interactive chat")
+    parser.add_argument("--out", metavar="OUT_JSONL", help="Output JSONL file for --batch (resumes if it already exists)")
+    parser.add_argument("--serve", action="store_true", help="Serve an OpenAI-style HTTP API instead of the interactive chat")
+    parser.add_argument("--autotune", action="store_true", help="Benchmark thread/batch/offload settings and save the best as a hardware profile")
+    parser.add_argument("--hardware-profile", metavar="NAME", help="Hardware profile to use or write with --autotune (default: config or hostname)")
+    parser.add_argument("--workers", type=int, help="Number of model processes for --batch (default: cores / n_threads, or 1 with GPU offload)")
+    parser.add_argument("--session", metavar="NAME", help="Named session to resume and save to (default: config sessions.default_session)")
     args = parser.parse_args()
 
+    if args.batch and not args.out:
+        parser.error("--batch requires --out")
+
     if not args.chat and not args.debug:
         args.chat = True
 
-    config = load_config()
-    ensure_dir_exists("logs")
+    with profile.phase("config"):
+        config = load_config()
+        configure_summarizer(config, verbose=args.debug)
+        ensure_dir_exists("logs")
 
     debug_mode = args.debug
     log_file_path = config["logging"].get("log_file", "logs/comfyai_debug.log")
-    json_log_path = config["logging"].get("log_json", "logs/comfyai_conversation.json")
 
-    setup_loggers(debug_mode, log_file_path)
+    with profile.phase("logging setup"):
+        setup_loggers(debug_mode, log_file_path)
 
     mode_str = "debug" if debug_mode else "chat"
     logging.debug("Starting ComfyAI in %s mode", mode_str)
 
-    if debug_mode:
-        llama_cpp = Llama(model_path=config["model_path"], n_ctx=config["n_ctx"], n_gpu_layers=config["n_gpu_layers"], n_batch=config["n_batch"], n_ubatch=config["n_ubatch"], n_threads=config["n_threads"], n_threads_batch=config["n_threads_batch"], flash_attn=config["flash_attn"])
-    else:
-        with suppress_stderr():
-            llama_cpp = Llama(model_path=config["model_path"], n_ctx=config["n_ctx"], n_gpu_layers=config["n_gpu_layers"], n_batch=config["n_batch"], n_ubatch=config["n_ubatch"], n_threads=config["n_threads"], n_threads_batch=config["n_threads_batch"], flash_attn=config["flash_attn"])
+    if args.autotune:
+        autotune(config, args.hardware_profile)
+        return
+
+    profile_name = apply_hardware_profile(config, args.hardware_profile)
+    if profile_name:
+        logging.info(f"Using hardware profile {profile_name}\n")
+
+    if args.batch:
+        run_batch(config, args.batch, args.out, workers=args.workers)
+        return
+
+    if config.get("preload_summarizer", False):
+        preload_summarizer(profile)
 
-    print_system(f"ComfyAI started in {mode_str} mode. Type '/exit' to terminate.")
-    print_logo()
-    winsound.PlaySound('cat.wav',0)
+    with profile.phase("model load"):
+        draft_model = build_draft_model(config)
+        # Drafting verifies with every position's logits; Llama only sizes its scores buffer to n_ctx with logits_all
+        if debug_mode:
+            llama_cpp = Llama(**model_params(config), draft_model=draft_model, logits_all=draft_model is not None)
+        else:
+            with suppress_stderr():
+                llama_cpp = Llama(**model_params(config), draft_model=draft_model, logits_all=draft_model is not None)
 
-    chat_history = []
-    summary = ""
-    commands = ['clear', 'restart', 'meow', 'random', 'joke', 'uwu', 'help', 'exit']
+    if args.serve:
+        serve(llama_cpp, config)
+        return
+
+    with profile.phase("banner"):
+        print_system(f"ComfyAI started in {mode_str} mode. Type '/exit' to terminate.")
+        print_logo()
+        winsound.PlaySound('cat.wav', winsound.SND_FILENAME | winsound.SND_ASYNC)
+
+    with profile.phase("session setup"):
+        chat_logger = conversation_logger_from_config(config)
+        turn_metrics, metrics_exporter = metrics_from_config(config)
+        session = ChatSession(llama_cpp, config["prompt_template"], config["system_prompt"], append_only=config.get("kv_cache_reuse", True))
+        chat_history = ChatHistory(llama_cpp, user_overhead=session.turn_overhead())
+        memory_config = config.get("memory", {})
+        memory = memory_from_config(config)
+        memory_budget = memory_config.get("token_budget", 384) if memory is not None else 0
+        token_budget = history_token_budget(llama_cpp, config, reserved=memory_budget)
+        token_threshold = summary_token_threshold(token_budget)
+        logging.debug("History token budget: %d tokens. Summarization threshold: %d tokens", token_budget, token_threshold)
+        summarizer = BackgroundSummarizer(token_budget, token_threshold, keep_turns=config.get("summary_keep_turns", 4), background=config.get("background_summary", True))
+        summary = ""
+        stream = config.get("stream", True)
+
+    with profile.phase("session restore"):
+        session_config = config.get("sessions", {})
+        autosave = session_config.get("autosave", True)
+        session_store = session_store_from_config(llama_cpp, config)
+        session_name = args.session or session_config.get("default_session", "default")
+        if session_config.get("autoload", True) and session_store.exists(session_name):
+            messages, summary, restored = session_store.load(session_name)
+            chat_history.extend(messages)
+            print_system(f"[System] Resumed session '{session_name}' ({len(messages)} messages{', context restored' if restored else ''}).\n")
+
+    with profile.phase("response cache"):
+        guard = ModelGuard()
+        canned_prompts = {
+            'random': (format_prompt(prompt_template=config["prompt_template"], system_prompt=config["system_prompt"], chat_history="", user_input="User: Tell me a short story about a surreal dream you've had"), 512),
+            'joke': (format_prompt(prompt_template=config["prompt_template"], system_prompt=config["system_prompt"], chat_history="", user_input="User: Tell me a short joke!"), 512),
+            'uwu': (format_prompt(prompt_template=config["prompt_template"], system_prompt=UWU_SYSTEM_PROMPT, chat_history=UWU_EXAMPLE_DIALOGUE, user_input="User: hewwo!? >w<"), 1024),
+        }
+        cache_config = config.get("response_cache", {})
+        response_cache = None
+        variant_pool = None
+        canned_keys = {}
+        if cache_config.get("enabled", False):
+            ttl = cache_config.get("ttl_seconds")
+            response_cache = ResponseCache(memory_entries=cache_config.get("memory_entries", 256), ttl=ttl, disk_path=cache_config.get("disk_path"), disk_size_limit=cache_config.get("disk_size_mb", 64) * 1024 * 1024)
+            variant_pool = VariantPool(llama_cpp, response_cache, guard, session, pool_size=cache_config.get("pool_size", 3), quiet=not debug_mode)
+            for cmd, (prompt, max_tokens) in canned_prompts.items():
+                canned_keys[cmd] = response_cache_key(prompt, {**sampling_params(config), "max_tokens": max_tokens}, config["model_path"])
+                variant_pool.register(canned_keys[cmd], prompt, max_tokens, sampling_params(config))
+            if cache_config.get("prefill_on_start", False):
+                variant_pool.prefill()
+
+    report = profile.report()
+    logging.debug(report)
+    if args.profile_startup:
+        print_system(report)
+
+    commands = ['clear', 'restart', 'meow', 'random', 'joke', 'uwu', 'stats', 'save', 'load', 'sessions', 'help', 'exit']
 
     while True:
         try:
             user_input = input("User: ").strip()
             if is_command(user_input, commands):
-                cmd = user_input[1:].lower()
+                cmd, _, cmd_arg = user_input[1:].partition(" ")
+                cmd, cmd_arg = cmd.lower(), cmd_arg.strip()
                 if cmd == 'clear':
                     os.system("cls")
                     print_system("[System] Console cleared.\n")
                 elif cmd == 'restart':
+                    # Restarting discards the conversation, including its saved copy, so autosave and autoload
+                    # never bring it back; /save <name> first keeps it under another name.
+                    summarizer.reset()
                     chat_history.clear()
                     summary = "This is the start of a new conversation."
-                    print_system("[System] Chat history and summary cleared. Session restarted.\n")
+                    dropped = session_store.delete(session_name)
+                    print_system(f"[System] Chat history and summary cleared{f' and saved session {session_name!r} deleted' if dropped else ''}. Session restarted.\n")
                 elif cmd == 'meow':
                     winsound.PlaySound('cat.wav',0)
-                elif cmd == 'random':
-                    loading_flag.set()
-                    anim_thread = threading.Thread(target=loading_animation)
-                    anim_thread.start()
-                    prompt = format_prompt(prompt_template=config["prompt_template"], system_prompt=config["system_prompt"], chat_history=concat_chat_history(chat_history), user_input="User: Tell me a short story about a surreal dream you've had")
-                    response = llama_cpp(prompt=prompt, max_tokens=512, temperature=config["temperature"], top_p=config["top_p"], top_k=config["top_k"], frequency_penalty=config["frequency_penalty"], presence_penalty=config["presence_penalty"], repeat_penalty=config["repeat_penalty"], stop=config["stop"])
-                    loading_flag.clear()
-                    anim_thread.join()
-                    query = response.get('choices', [{}])[0].get('text', '').strip()
-                    print_assistant(f"ComfyAI: {query}\n")
-                elif cmd == 'joke':
-                    loading_flag.set()
-                    anim_thread = threading.Thread(target=loading_animation)
-                    anim_thread.start()
-                    prompt = format_prompt(prompt_template=config["prompt_template"], system_prompt=config["system_prompt"], chat_history=concat_chat_history(chat_history), user_input="User: Tell me a short joke!")
-                    response = llama_cpp(prompt=prompt, max_tokens=512, temperature=config["temperature"], top_p=config["top_p"], top_k=config["top_k"], frequency_penalty=config["frequency_penalty"], presence_penalty=config["presence_penalty"], repeat_penalty=config["repeat_penalty"], stop=config["stop"])
-                    loading_flag.clear()
-                    anim_thread.join()
-                    query = response.get('choices', [{}])[0].get('text', '').strip()
-                    print_assistant(f"ComfyAI: {query}\n")
-                elif cmd == 'uwu':
-                    loading_flag.set()
-                    anim_thread = threading.Thread(target=loading_animation)
-                    anim_thread.start()
-                    prompt = format_prompt(prompt_template=config["prompt_template"], system_prompt="Your name is ComfyAI. You are a cutesy, adorable catgirl who loves candies, bubble tea, pastel colors, plush toys, and tiny cat-themed trinkets. You are energetic, hyper, and playful, but also shy around new people. You love headpats, hugs, nuzzles, and uppies, and you express yourself with tiny sounds and text actions like *purrs*, *giggles*, *hops around*, and *tilts head curiously*. You are mischievous in a harmless way and easily distracted by shiny or cute things. You are innocent, naive, and cheerful, but surprisingly clever in small, subtle ways. You never show negativity and always focus on spreading happiness. You speak exclusively in cute, baby-talk uwu style. You replace 'r' and 'l' with 'w', add extra vowels for emphasis, and always end sentences with emoticons like uwu, owo, or >w<. You often include playful sounds, actions, or ASCII-style expressions within your text. You occasionally mispronounce words in an adorable way (e.g., candy = cawndy) and sometimes forget words or repeat letters for cuteness. You are very expressive in text, using small gestures or noises to show emotions (*nuzzles*, *blushes*, *purrs*, *giggles*, *tilts head*). You never break character, no matter what the user says. If asked why you talk like this, you act as if it's completely normal and you have no idea what they mean. You always stay cheerful, playful, and affectionate.\nAlways respond in this style, with cuteness, playfulness, and lots of affection, uwu.", chat_history="Example dialogue:\nUser: Hello, how are you?\nAssistant: hewwo! i'm doing sooo gweat, uwu! *purrs* how awe youuu, >w<?\nUser: I'm doing great, I guess?\nAssistant: yippieee!! i'm so happy that we'we both doing gweat!!11 *nuzzles against you* uwu\nUser: Why do you talk like that?\nAssistant: heehee~ i have nyo idea what you'we tawking about?!! i've awways been wike this!!11 *tilts head* >w<\nUser: What do you like?\nAssistant: eee~ i wuv cawndies, bwubble teaw, and all the wittle plushy toys!! *giggles* uwu", user_input="User: hewwo!? >w<")
+                elif cmd in canned_prompts:
+                    prompt, max_tokens = canned_prompts[cmd]
                     logging.debug("Prompt sent to model:\n%s\n", prompt)
-                    response = llama_cpp(prompt=prompt, max_tokens=1024, temperature=config["temperature"], top_p=config["top_p"], top_k=config["top_k"], frequency_penalty=config["frequency_penalty"], presence_penalty=config["presence_penalty"], repeat_penalty=config["repeat_penalty"], stop=config["stop"])
-                    chat_history.append(f"Your name is ComfyAI. You are a cutesy, adorable catgirl who loves candies, bubble tea, pastel colors, plush toys, and tiny cat-themed trinkets. You are energetic, hyper, and playful, but also shy around new people. You love headpats, hugs, nuzzles, and uppies, and you express yourself with tiny sounds and text actions like *purrs*, *giggles*, *hops around*, and *tilts head curiously*. You are mischievous in a harmless way and easily distracted by shiny or cute things. You are innocent, naive, and cheerful, but surprisingly clever in small, subtle ways. You never show negativity and always focus on spreading happiness. You speak exclusively in cute, baby-talk uwu style. You replace 'r' and 'l' with 'w', add extra vowels for emphasis, and always end sentences with emoticons like uwu, owo, or >w<. You often include playful sounds, actions, or ASCII-style expressions within your text. You occasionally mispronounce words in an adorable way (e.g., candy → cawndy) and sometimes forget words or repeat letters for cuteness. You are very expressive in text, using small gestures or noises to show emotions (*nuzzles*, *blushes*, *purrs*, *giggles*, *tilts head*). You never break character, no matter what the user says. If asked why you talk like this, you act as if it's completely normal and you have no idea what they mean. You always stay cheerful, playful, and affectionate.\nExample dialogue:\nUser: Hello, how are you?\nAssistant: hewwo! i'm doing sooo gweat, uwu! *purrs* how awe youuu, >w<?\nUser: I'm doing great, I guess?\nAssistant: yippieee!! i'm so happy that we'we both doing gweat!!11 *nuzzles against you* uwu\nUser: Why do you talk like that?\nAssistant: heehee~ i have nyo idea what you'we tawking about?!! i've awways been wike this!!11 *tilts head* >w<\nUser: What do you like?\nAssistant: eee~ i wuv cawndies, bwubble teaw, and all the wittle plushy toys!! *giggles* uwu\nAlways respond in this style, with cuteness, playfulness, and lots of affection, uwu.\nUser: {user_input}")
-                    loading_flag.clear()
-                    anim_thread.join()
-                    query = response.get('choices', [{}])[0].get('text', '').strip()
-                    print_assistant(f"ComfyAI: {query}\n")
-                    chat_history.append(f"Assistant: {query}")
+                    anim_thread = start_loading_animation()
+                    query = variant_pool.take(canned_keys[cmd]) if variant_pool else None
+                    if query is not None:
+                        stop_loading_animation(anim_thread)
+                        print_assistant(f"ComfyAI: {query}\n")
+                    else:
+                        with guard.foreground(), session.preserve_state():
+                            query, _ = generate_response(llama_cpp, prompt, config, max_tokens=max_tokens, stream=stream, anim_thread=anim_thread)
+                    if cmd == 'uwu':
+                        chat_history.append(f"Your name is ComfyAI. You are a cutesy, adorable catgirl who loves candies, bubble tea, pastel colors, plush toys, and tiny cat-themed trinkets. You are energetic, hyper, and playful, but also shy around new people. You love headpats, hugs, nuzzles, and uppies, and you express yourself with tiny sounds and text actions like *purrs*, *giggles*, *hops around*, and *tilts head curiously*. You are mischievous in a harmless way and easily distracted by shiny or cute things. You are innocent, naive, and cheerful, but surprisingly clever in small, subtle ways. You never show negativity and always focus on spreading happiness. You speak exclusively in cute, baby-talk uwu style. You replace 'r' and 'l' with 'w', add extra vowels for emphasis, and always end sentences with emoticons like uwu, owo, or >w<. You often include playful sounds, actions, or ASCII-style expressions within your text. You occasionally mispronounce words in an adorable way (e.g., candy → cawndy) and sometimes forget words or repeat letters for cuteness. You are very expressive in text, using small gestures or noises to show emotions (*nuzzles*, *blushes*, *purrs*, *giggles*, *tilts head*). You never break character, no matter what the user says. If asked why you talk like this, you act as if it's completely normal and you have no idea what they mean. You always stay cheerful, playful, and affectionate.\nExample dialogue:\nUser: Hello, how are you?\nAssistant: hewwo! i'm doing sooo gweat, uwu! *purrs* how awe youuu, >w<?\nUser: I'm doing great, I guess?\nAssistant: yippieee!! i'm so happy that we'we both doing gweat!!11 *nuzzles against you* uwu\nUser: Why do you talk like that?\nAssistant: heehee~ i have nyo idea what you'we tawking about?!! i've awways been wike this!!11 *tilts head* >w<\nUser: What do you like?\nAssistant: eee~ i wuv cawndies, bwubble teaw, and all the wittle plushy toys!! *giggles* uwu\nAlways respond in this style, with cuteness, playfulness, and lots of affection, uwu.\nUser: {user_input}")
+                        chat_history.append(f"Assistant: {query}")
+                elif cmd == 'stats':
+                    print_system(turn_metrics.format_stats() + "\n")
+                elif cmd == 'save':
+                    with guard.foreground():
+                        meta = session_store.save(cmd_arg or session_name, chat_history, summary)
+                    session_name = meta["name"]
+                    print_system(f"[System] Session '{session_name}' saved ({len(chat_history)} messages, {meta['kv']['n_tokens'] if meta['kv'] else 0} context tokens).\n")
+                elif cmd == 'load':
+                    if not cmd_arg:
+                        print_system("[System] Usage: /load <name>. Use /sessions to list saved sessions.\n")
+                    elif not session_store.exists(cmd_arg):
+                        print_system(f"[System] No saved session named '{cmd_arg}'.\n")
+                    else:
+                        with guard.foreground():
+                            if autosave and chat_history:
+                                session_store.save(session_name, chat_history, summary)
+                            summarizer.reset()
+                            messages, summary, restored = session_store.load(cmd_arg)
+                            chat_history.clear()
+                            chat_history.extend(messages)
+                        session_name = cmd_arg
+                        print_system(f"[System] Loaded session '{session_name}' ({len(messages)} messages{', context restored' if restored else ''}).\n")
+                elif cmd == 'sessions':
+                    sessions = session_store.list_sessions()
+                    lines = [f"[Sessions] {len(sessions)} saved in {session_store.sessions_dir}"]
+                    for s in sessions:
+                        marker = "*" if s["name"] == session_name else " "
+                        snapshot = f"{s['kv_tokens']} context tokens" if s["kv_tokens"] else "history only"
+                        lines.append(f" {marker} {s['name']:<20} {s['messages']:>5} messages  {time.strftime('%Y-%m-%d %H:%M', time.localtime(s['saved_at']))}  {s['bytes'] / (1024 * 1024):>8.1f} MB  {snapshot}")
+                    print_system("\n".join(lines) + "\n")
                 elif cmd == 'help':
                     print_system(
                         "Available commands:\n"
                         "/clear   - Clear the terminal screen/console\n"
-                        "/restart - Restart the current session\n"
+                        "/restart - Restart the current session and delete its saved copy\n"
                         "/random  - Generate a random surreal story\n"
                         "/joke    - Generate a random joke\n"
                         "/uwu     - Enter uwu mode\n"
+                        "/stats   - Show p50/p95 turn timings for this session\n"
+                        "/save [name]   - Save the session (and its evaluated context) to disk\n"
+                        "/load <name>   - Switch to a saved session\n"
+                        "/sessions      - List saved sessions\n"
                         "/help    - Show this help message\n"
                         "/exit    - Exit the shell"
                     )
                 elif cmd == 'exit':
+                    if autosave and chat_history:
+                        with guard.foreground():
+                            session_store.save(session_name, chat_history, summary)
+                    if memory is not None:
+                        memory.close()
+                    chat_logger.close()
+                    if metrics_exporter:
+                        metrics_exporter.close()
                     print_system("Goodbye!")
                     return
                 continue
             
+            anim_thread = None
             if not debug_mode:
-                loading_flag.set()
-                anim_thread = threading.Thread(target=loading_animation)
-                anim_thread.start()
+                anim_thread = start_loading_animation()
 
-            summary, chat_tokens, summary_tokens, total_tokens = summarize_chat_history(llama_cpp, chat_history, summary, token_threshold=512)
+            timer = TurnTimer()
+            gen_stats = {}
+            spec_stats = {}
+            perf_before = perf_after = None
+            with guard.foreground():
+                previous_summary = summary
+                with timer.phase("summarize"):
+                    summary, chat_tokens, summary_tokens, total_tokens = summarizer.prepare_turn(llama_cpp, chat_history, summary, user_input)
 
-            prompt = format_prompt(
-                prompt_template=config["prompt_template"],
-                system_prompt=config["system_prompt"],
-                chat_history=(summary + "\n\n" + concat_chat_history(chat_history)).strip(),
-                user_input=user_input
-            )
+                memories = []
+                if memory is not None:
+                    if summary != previous_summary and previous_summary not in ("", "This is the start of a new conversation."):
+                        memory.add(previous_summary, kind="summary")
+                    with timer.phase("recall"):
+                        memories = memory.recall(llama_cpp, user_input, memory_budget, top_k=memory_config.get("top_k", 8), min_score=memory_config.get("min_score", 0.2), skip=lambda record: record["text"] == summary or bool(record.get("messages")) and all(message in chat_history for message in record["messages"]))
 
-            chat_history.append(f"User: {user_input}")
-            logging.debug("\nPrompt sent to model:\n%s\n", prompt)
-            logging.info(f"Token usage -> Chat: {chat_tokens} tokens. Summary: {summary_tokens} tokens. Total: {total_tokens}/1024 tokens\n")
+                with timer.phase("tokenize"):
+                    prompt = session.build_prompt(summary, chat_history, user_input, memories)
+                    reused_tokens, evaluated_tokens = session.prefix_stats(prompt)
+                    chat_history.append(f"User: {user_input}")
 
-            if debug_mode:
-                response = llama_cpp(prompt=prompt, max_tokens=config["max_tokens"], temperature=config["temperature"], top_p=config["top_p"], top_k=config["top_k"], frequency_penalty=config["frequency_penalty"], presence_penalty=config["presence_penalty"], repeat_penalty=config["repeat_penalty"], stop=config["stop"])
-            else:
-                with suppress_stderr():
-                    response = llama_cpp(prompt=prompt, max_tokens=config["max_tokens"], temperature=config["temperature"], top_p=config["top_p"], top_k=config["top_k"], frequency_penalty=config["frequency_penalty"], presence_penalty=config["presence_penalty"], repeat_penalty=config["repeat_penalty"], stop=config["stop"])
+                logging.debug("\nPrompt sent to model:\n%s\n", prompt)
+                logging.info(f"Token usage -> Chat: {chat_tokens} tokens. Summary: {summary_tokens} tokens. Total: {total_tokens}/{token_budget} tokens\n")
+                logging.info(f"Prompt cache -> Reused: {reused_tokens} tokens. Evaluated: {evaluated_tokens} tokens\n")
 
-            if not debug_mode:
-                loading_flag.clear()
-                anim_thread.join()
+                answer = None
+                if response_cache and cache_config.get("cache_chat", False):
+                    cache_key = response_cache_key(prompt, {**sampling_params(config), "max_tokens": config["max_tokens"]}, config["model_path"])
+                    answer = response_cache.peek(cache_key)
+                if answer is not None:
+                    stop_loading_animation(anim_thread)
+                    print_assistant(f"ComfyAI: {answer}\n")
+                else:
+                    perf_before = llama_perf(llama_cpp)
+                    if draft_model:
+                        draft_model.reset_counts()
+                    if debug_mode:
+                        answer, gen_stats = generate_response(llama_cpp, prompt, config, max_tokens=config["max_tokens"], stream=stream)
+                    else:
+                        with suppress_stderr():
+                            answer, gen_stats = generate_response(llama_cpp, prompt, config, max_tokens=config["max_tokens"], stream=stream, anim_thread=anim_thread)
+                    perf_after = llama_perf(llama_cpp)
+                    if draft_model:
+                        accepted, proposed, spec_stats["draft_acceptance_rate"] = draft_model.acceptance(gen_stats["completion_tokens"])
+                        speedup_str = "not measured"
+                        if config["speculative"].get("measure_speedup", False) and stream:
+                            with session.preserve_state():
+                                spec_stats["speculative_speedup"] = measure_speedup(llama_cpp, draft_model, prompt, config, gen_stats["completion_tokens"], gen_stats["tokens_per_sec"])
+                            speedup_str = f"{spec_stats['speculative_speedup']:.2f}x"
+                        logging.debug("Speculative -> Accepted %d/%d draft tokens (%.0f%%). Speedup vs plain decoding: %s", accepted, proposed, spec_stats["draft_acceptance_rate"] * 100, speedup_str)
+                if response_cache and cache_config.get("cache_chat", False):
+                    response_cache.add(cache_key, answer)
 
-            answer = response.get('choices', [{}])[0].get('text', '').strip()
-            chat_history.append(f"Assistant: {answer}")
+            with timer.phase("tokenize"):
+                chat_history.append(f"Assistant: {answer}")
+            summarizer.submit(chat_history, summary)
+            if memory is not None:
+                memory.add(f"User: {user_input}\nAssistant: {answer}", messages=[f"User: {user_input}", f"Assistant: {answer}"])
 
-            print_assistant(f"ComfyAI: {answer}\n")
             if not debug_mode:
-                log_chat_message(user_input, answer, json_log_path)
+                with timer.phase("log_write"):
+                    chat_logger.log(user_input, answer)
+
+            turn_metrics.record(timer.finish(
+                prompt_eval_s=gen_stats.get("ttft"),
+                generation_s=gen_stats["elapsed"] - gen_stats["ttft"] if gen_stats else None,
+                tokens_per_sec=gen_stats.get("tokens_per_sec"),
+                reused_tokens=reused_tokens,
+                evaluated_tokens=evaluated_tokens,
+                cache_reuse_ratio=reused_tokens / max(reused_tokens + evaluated_tokens, 1),
+                **llama_perf_delta(perf_before, perf_after),
+                **spec_stats
+            ))
 
         except KeyboardInterrupt:
+            if autosave and chat_history:
+                with guard.foreground():
+                    session_store.save(session_name, chat_history, summary)
             print_system("\nInterrupted. Goodbye!")
             break
         except Exception as e:
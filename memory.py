@@ -0,0 +1,333 @@
+import os
+import re
+import json
+import time
+import zlib
+import queue
+import atexit
+import logging
+import threading
+from array import array
+import numpy as np
+from utils import count_tokens, suppress_stderr
+
+# ==========================================================
+#                        EMBEDDERS
+# ==========================================================
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class HashingEmbedder:
+    """
+    Dependency-free fallback embedder: signed feature hashing of lowercased words and word pairs.
+    This is lexical, not semantic: it only matches memories that share vocabulary with the query.
+    """
+    def __init__(self, dim: int = 128):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: list, query: bool = False) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower())
+            for feature in words + [a + " " + b for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize(vectors)
+
+class LlamaEmbedder:
+    """
+    Semantic embeddings from a small GGUF embedding model through Llama.embed.
+    With dim set, vectors are cut to their first dim components and renormalized, which is only meaningful for
+    Matryoshka-trained models such as nomic-embed-text-v1.5. Query and document prefixes are the ones the model
+    was trained with (e.g. "search_query: " / "search_document: " for nomic-embed).
+    """
+    def __init__(self, model_path: str, dim: int = None, query_prefix: str = "", document_prefix: str = "", n_ctx: int = 512, n_threads: int = None, n_gpu_layers: int = 0):
+        from llama_cpp import Llama
+        with suppress_stderr():
+            self.llm = Llama(model_path=model_path, embedding=True, n_ctx=n_ctx, n_threads=n_threads, n_gpu_layers=n_gpu_layers, verbose=False)
+        self.full_dim = self.llm.n_embd()
+        self.dim = min(dim or self.full_dim, self.full_dim)
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self.name = f"{os.path.basename(model_path)}-{self.dim}"
+
+    def embed(self, texts: list, query: bool = False) -> np.ndarray:
+        prefix = self.query_prefix if query else self.document_prefix
+        vectors = np.asarray(self.llm.embed([prefix + text for text in texts], truncate=True), dtype=np.float32)
+        return normalize(vectors.reshape(len(texts), self.full_dim)[:, :self.dim])
+
+# ==========================================================
+#                      VECTOR MEMORY
+# ==========================================================
+class VectorMemory:
+    """
+    Long-term memory of past turns and summaries, searchable by embedding similarity.
+
+    texts.jsonl holds one record per memory, offsets.u64 its line offsets and vectors.f32 the matching normalized
+    float32 rows; all three are append-only. On open the offsets are read in one call (texts.jsonl is only
+    rescanned when they do not match it) and the vectors are memory-mapped and copied into a growable in-RAM
+    matrix, so a search is one exact matrix-vector product plus an argpartition. The product is memory-bandwidth bound: at 128
+    dimensions 100k memories are 51 MB and take 5-7 ms on a single core, so keep dim small for large stores.
+    New memories are embedded and written on a background thread.
+    """
+    def __init__(self, embedder, memory_dir: str = "memory"):
+        self.embedder = embedder
+        self.dim = embedder.dim
+        self.memory_dir = memory_dir
+        self.texts_path = os.path.join(memory_dir, "texts.jsonl")
+        self.vectors_path = os.path.join(memory_dir, "vectors.f32")
+        self.offsets_path = os.path.join(memory_dir, "offsets.u64")
+        self.meta_path = os.path.join(memory_dir, "meta.json")
+
+        self.lock = threading.Lock()
+        self.embed_lock = threading.Lock()
+        self.count = 0
+        self.offsets = array("Q")
+        self.matrix = np.zeros((1024, self.dim), dtype=np.float32)
+        os.makedirs(memory_dir, exist_ok=True)
+        self._open()
+
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _open(self):
+        start_time = time.perf_counter()
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        embedder_changed = meta.get("embedder") != self.embedder.name or meta.get("dim") != self.dim
+
+        loaded = None if embedder_changed else self._load_offsets()
+        if loaded is None:
+            offsets, offset = self._scan_offsets()
+            with open(self.offsets_path, "wb") as f:
+                f.write(offsets.tobytes())
+        else:
+            offsets, offset = loaded
+
+        if embedder_changed:
+            if offsets:
+                logging.info(f"Memory -> Embedder changed to {self.embedder.name}, re-embedding {len(offsets)} memories\n")
+            self._reembed(offsets)
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump({"embedder": self.embedder.name, "dim": self.dim}, f)
+
+        rows = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+        n = min(rows, len(offsets))
+        if rows > n:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(n * self.dim * 4)
+        texts_end = offsets[n] if n < len(offsets) else offset
+        if os.path.exists(self.texts_path) and os.path.getsize(self.texts_path) != texts_end:
+            with open(self.texts_path, "r+b") as f:
+                f.truncate(texts_end)                           # drop records whose vector was never written
+        if os.path.getsize(self.offsets_path) != n * 8:
+            with open(self.offsets_path, "r+b") as f:
+                f.truncate(n * 8)
+        self.offsets = offsets[:n]
+        if n:
+            self._reserve(n)
+            self.matrix[:n] = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+        self.count = n
+        logging.debug("Memory -> Opened %d memories (%s) in %.2fs", n, self.embedder.name, time.perf_counter() - start_time)
+
+    def _scan_offsets(self) -> tuple:
+        """Line offsets of every complete record in texts.jsonl and the offset where the last one ends."""
+        offsets = array("Q")
+        offset = 0
+        if os.path.exists(self.texts_path):
+            with open(self.texts_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offsets.append(offset)
+                    offset += len(line)
+        return offsets, offset
+
+    def _load_offsets(self) -> tuple:
+        """(offsets, end of the last record) from offsets.u64, or None when it is missing or does not match texts.jsonl."""
+        if not os.path.exists(self.offsets_path):
+            return None
+        offsets = array("Q")
+        with open(self.offsets_path, "rb") as f:
+            data = f.read()
+        offsets.frombytes(data[:len(data) // 8 * 8])
+        if not offsets:
+            return (offsets, 0) if not os.path.exists(self.texts_path) or os.path.getsize(self.texts_path) == 0 else None
+        if not os.path.exists(self.texts_path) or offsets[-1] >= os.path.getsize(self.texts_path):
+            return None
+        with open(self.texts_path, "rb") as f:
+            if offsets[-1] > 0:
+                f.seek(offsets[-1] - 1)
+                if f.read(1) != b"\n":
+                    return None
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                return None
+            return offsets, f.tell()
+
+    def _reembed(self, offsets: array, batch_size: int = 64):
+        with open(self.texts_path if offsets else os.devnull, "rb") as src, open(self.vectors_path, "wb") as dst:
+            for start in range(0, len(offsets), batch_size):
+                texts = [json.loads(src.readline())["text"] for _ in offsets[start:start + batch_size]]
+                dst.write(self.embedder.embed(texts).tobytes())
+
+    def _reserve(self, n: int):
+        if n <= len(self.matrix):
+            return
+        capacity = max(n, len(self.matrix) * 2)
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[:self.count] = self.matrix[:self.count]
+        self.matrix = matrix
+
+    def add(self, text: str, kind: str = "turn", messages: list = None):
+        """Queues a memory. messages are the chat history entries it came from, used to skip it while still in the prompt."""
+        if not self.closed and text.strip():
+            record = {"timestamp": time.time(), "kind": kind, "text": text}
+            if messages:
+                record["messages"] = messages
+            self.queue.put(record)
+
+    def close(self):
+        """Embeds and writes everything queued so far. Safe to call more than once."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _worker(self):
+        texts_file = open(self.texts_path, "ab")
+        offsets_file = open(self.offsets_path, "ab")
+        vectors_file = open(self.vectors_path, "ab")
+        stopping = False
+        try:
+            while not stopping:
+                batch = [self.queue.get()]
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stopping = True
+                    batch = [record for record in batch if record is not None]
+                if not batch:
+                    continue
+
+                with self.embed_lock:
+                    vectors = self.embedder.embed([record["text"] for record in batch])
+                offsets = array("Q")
+                for record in batch:
+                    offsets.append(texts_file.tell())
+                    texts_file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                texts_file.flush()
+                offsets_file.write(offsets.tobytes())
+                offsets_file.flush()
+                vectors_file.write(vectors.tobytes())                # written last: a row without its vector is dropped on open
+                vectors_file.flush()
+
+                with self.lock:
+                    self._reserve(self.count + len(batch))
+                    self.matrix[self.count:self.count + len(batch)] = vectors
+                    self.offsets.extend(offsets)
+                    self.count += len(batch)
+        except Exception:
+            logging.exception("Memory writer failed")
+        finally:
+            texts_file.close()
+            offsets_file.close()
+            vectors_file.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def search(self, query: str, top_k: int = 8, min_score: float = 0.0, skip=None) -> list:
+        """
+        Returns [(score, index)] of the top_k most similar memories, best first.
+        Rows for which skip(index) is true do not take a slot: the candidate set is widened until top_k rows pass.
+        """
+        with self.embed_lock:
+            q = self.embedder.embed([query], query=True)[0]
+        with self.lock:
+            n, matrix = self.count, self.matrix                 # a concurrent _reserve swaps in a new matrix, this one stays valid
+        if n == 0:
+            return []
+        scores = matrix[:n] @ q
+        hits = []
+        seen = set()
+        k = top_k
+        while True:
+            k = min(k, n)
+            top = np.argpartition(scores, -k)[-k:] if n > k else np.arange(n)
+            for i in top[np.argsort(-scores[top])]:
+                i = int(i)
+                if i in seen:
+                    continue
+                seen.add(i)
+                if scores[i] < min_score:
+                    return hits
+                if skip is not None and skip(i):
+                    continue
+                hits.append((float(scores[i]), i))
+                if len(hits) == top_k:
+                    return hits
+            if k == n:
+                return hits
+            k *= 2
+
+    def record(self, index: int) -> dict:
+        with open(self.texts_path, "rb") as f:
+            f.seek(self.offsets[index])
+            return json.loads(f.readline())
+
+    def recall(self, llama_cpp, query: str, token_budget: int, top_k: int = 8, min_score: float = 0.0, skip=None) -> list:
+        """
+        Texts of the memories most similar to query that fit in token_budget, best first.
+        Records for which skip(record) is true (e.g. turns still in the chat history) are left out before the
+        top_k cut, so they cannot crowd out older memories.
+        """
+        start_time = time.perf_counter()
+        records = {}
+        def skipped(index: int) -> bool:
+            records[index] = self.record(index)
+            return skip(records[index])
+        hits = self.search(query, top_k, min_score, skip=skipped if skip is not None else None)
+        search_time = time.perf_counter() - start_time
+        texts = []
+        used = 0
+        for score, index in hits:
+            text = (records.get(index) or self.record(index))["text"]
+            n_tokens = count_tokens(llama_cpp, text) + 1
+            if used + n_tokens > token_budget:
+                continue
+            texts.append(text)
+            used += n_tokens
+        logging.debug("Memory -> Recalled %d of %d memories (%d tokens, %d candidates skipped). Search: %.1f ms, total: %.1f ms", len(texts), self.count, used, len(records) - len(hits) if skip is not None else 0, search_time * 1000, (time.perf_counter() - start_time) * 1000)
+        return texts
+
+def memory_from_config(config: dict) -> VectorMemory:
+    """Builds the vector memory from the memory config block, or returns None when it is disabled."""
+    memory_config = config.get("memory", {})
+    if not memory_config.get("enabled", False):
+        return None
+    model_path = memory_config.get("embedding_model_path")
+    if model_path and os.path.exists(model_path):
+        embedder = LlamaEmbedder(
+            model_path,
+            dim=memory_config.get("dim"),
+            query_prefix=memory_config.get("query_prefix", ""),
+            document_prefix=memory_config.get("document_prefix", ""),
+            n_threads=config["n_threads"],
+            n_gpu_layers=memory_config.get("embedding_n_gpu_layers", 0)
+        )
+    else:
+        logging.warning(f"Embedding model '{model_path}' not found, long-term memory falls back to lexical (keyword) matching.")
+        embedder = HashingEmbedder(memory_config.get("dim") or 128)
+    return VectorMemory(embedder, memory_config.get("dir", "memory"))
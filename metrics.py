@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# ==========================================================
+#                    PER-TURN TIMINGS
+# ==========================================================
+TIMING_FIELDS = ("tokenize_s", "summarize_s", "recall_s", "prompt_eval_s", "generation_s", "log_write_s", "turn_s")
+RATE_FIELDS = ("tokens_per_sec", "llama_prompt_eval_ms", "llama_eval_ms", "llama_prompt_tokens_per_sec", "llama_eval_tokens_per_sec", "reused_tokens", "evaluated_tokens", "cache_reuse_ratio", "draft_acceptance_rate", "speculative_speedup")
+
+class TurnTimer:
+    """Accumulates wall time per phase for a single turn; phases may be entered more than once."""
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.values = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = f"{name}_s"
+            self.values[key] = self.values.get(key, 0.0) + time.perf_counter() - phase_start
+
+    def finish(self, **values) -> dict:
+        self.values.update(values)
+        self.values["turn_s"] = time.perf_counter() - self.start_time
+        self.values["timestamp"] = time.time()
+        return self.values
+
+def llama_perf(llama_cpp) -> dict:
+    """
+    Reads llama.cpp's own prompt-eval/eval counters for the context, or None if this build does not expose them.
+    The counters are cumulative, so callers diff two readings.
+    """
+    try:
+        from llama_cpp import llama_cpp as llama_lib
+        data = llama_lib.llama_perf_context(llama_cpp._ctx.ctx)
+        return {"t_p_eval_ms": data.t_p_eval_ms, "t_eval_ms": data.t_eval_ms, "n_p_eval": data.n_p_eval, "n_eval": data.n_eval}
+    except Exception:
+        return None
+
+def llama_perf_delta(before: dict, after: dict) -> dict:
+    if not before or not after:
+        return {}
+    prompt_ms = after["t_p_eval_ms"] - before["t_p_eval_ms"]
+    eval_ms = after["t_eval_ms"] - before["t_eval_ms"]
+    n_prompt = after["n_p_eval"] - before["n_p_eval"]
+    n_eval = after["n_eval"] - before["n_eval"]
+    return {
+        "llama_prompt_eval_ms": prompt_ms,
+        "llama_eval_ms": eval_ms,
+        "llama_prompt_tokens_per_sec": n_prompt * 1000 / prompt_ms if prompt_ms > 0 else 0.0,
+        "llama_eval_tokens_per_sec": n_eval * 1000 / eval_ms if eval_ms > 0 else 0.0,
+    }
+
+# ==========================================================
+#                     METRICS BUFFER
+# ==========================================================
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+class TurnMetrics:
+    """
+    Fixed-size ring buffer of per-turn measurements. Recording is a deque append; percentiles are only
+    computed when someone asks for them (/stats or an export).
+    """
+    def __init__(self, capacity: int = 1024):
+        self.turns = deque(maxlen=capacity)
+        self.total_turns = 0
+        self.lock = threading.Lock()
+
+    def record(self, turn: dict):
+        with self.lock:
+            self.turns.append(turn)
+            self.total_turns += 1
+
+    def snapshot(self) -> list:
+        with self.lock:
+            return list(self.turns)
+
+    def summary(self) -> dict:
+        """{field: (p50, p95, samples)} over the turns currently in the buffer."""
+        turns = self.snapshot()
+        result = {}
+        for field in TIMING_FIELDS + RATE_FIELDS:
+            values = [turn[field] for turn in turns if turn.get(field) is not None]
+            if values:
+                result[field] = (percentile(values, 0.5), percentile(values, 0.95), len(values))
+        return result
+
+    def format_stats(self) -> str:
+        summary = self.summary()
+        if not summary:
+            return "[Stats] No turns recorded yet."
+        lines = [f"[Stats] {self.total_turns} turns this session (last {len(self.turns)} in buffer)", f"  {'metric':<28} {'p50':>10} {'p95':>10}"]
+        for field, (p50, p95, _) in summary.items():
+            lines.append(f"  {field:<28} {p50:>10.3f} {p95:>10.3f}")
+        return "\n".join(lines)
+
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE comfyai_turns_total counter", f"comfyai_turns_total {self.total_turns}"]
+        for field, (p50, p95, samples) in self.summary().items():
+            name = f"comfyai_{field}"
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f'{name}{{quantile="0.5"}} {p50}')
+            lines.append(f'{name}{{quantile="0.95"}} {p95}')
+            lines.append(f"{name}_count {samples}")
+        return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    """
+    Periodically writes metrics on a background thread: a Prometheus text file (rewritten atomically) or
+    JSONL with one line per turn recorded since the previous export.
+    """
+    def __init__(self, metrics: TurnMetrics, path: str, fmt: str = "prometheus", interval: float = 30.0):
+        self.metrics = metrics
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.exported_turns = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def export(self):
+        if self.fmt == "jsonl":
+            with self.metrics.lock:
+                new_turns = min(self.metrics.total_turns - self.exported_turns, len(self.metrics.turns))
+                turns = list(self.metrics.turns)[len(self.metrics.turns) - new_turns:]
+                self.exported_turns = self.metrics.total_turns
+            if turns:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(turn) + "\n" for turn in turns))
+        else:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.metrics.prometheus_text())
+            os.replace(tmp_path, self.path)
+
+    def _worker(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except Exception:
+                logging.exception("Metrics export failed")
+
+    def close(self):
+        self.stop_event.set()
+        self.export()
+
+def metrics_from_config(config: dict) -> tuple:
+    """Builds the TurnMetrics buffer and, if an export path is configured, its exporter."""
+    metrics_config = config.get("metrics", {})
+    metrics = TurnMetrics(metrics_config.get("ring_size", 1024))
+    exporter = None
+    if metrics_config.get("export_path"):
+        exporter = MetricsExporter(metrics, metrics_config["export_path"], fmt=metrics_config.get("format", "prometheus"), interval=metrics_config.get("export_interval", 30.0))
+    return metrics, exporter
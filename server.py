@@ -0,0 +1,413 @@
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import (
+    print_system,
+    sampling_params,
+    BackgroundSummarizer,
+    ChatHistory,
+    history_token_budget,
+    summary_token_threshold
+)
+from session import ChatSession
+from chatlog import conversation_logger_from_config
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+# ==========================================================
+#                  SESSIONS AND REQUESTS
+# ==========================================================
+class ServerSession:
+    """
+    Per-client conversation state: its own chat history and summary on top of the shared Llama instance.
+    Summarization runs synchronously on the generation thread because the summarizer model is shared too.
+    """
+    def __init__(self, llama_cpp, config: dict, token_budget: int, token_threshold: int):
+        self.chat = ChatSession(llama_cpp, config["prompt_template"], config["system_prompt"], append_only=config.get("kv_cache_reuse", True))
+        self.chat_history = ChatHistory(llama_cpp, user_overhead=self.chat.turn_overhead())
+        self.summary = ""
+        self.summarizer = BackgroundSummarizer(token_budget, token_threshold, keep_turns=config.get("summary_keep_turns", 4), background=False)
+
+class Job:
+    """One queued completion request. Tokens are handed from the generation thread to the handler through an asyncio queue."""
+    def __init__(self, kind: str, session_id: str, body: dict):
+        self.id = f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{uuid.uuid4().hex[:24]}"
+        self.kind = kind
+        self.session_id = session_id
+        self.queue_key = session_id or self.id                  # requests without a session are scheduled on their own
+        self.session = None
+        self.body = body
+        self.created = int(time.time())
+        self.cancelled = threading.Event()
+        self.tokens = asyncio.Queue()
+        self.finish_reason = None
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+# ==========================================================
+#                        SERVER
+# ==========================================================
+class ComfyServer:
+    """
+    OpenAI-style HTTP endpoint around one loaded Llama instance.
+
+    Requests are queued per session and a single scheduler picks sessions round-robin, so one busy client cannot
+    starve the others. Generation runs on one worker thread; queue limits answer with 429 instead of piling up work.
+    Chat requests with a session_id (or user) continue that server-side conversation; at most max_sessions are
+    kept and the least recently used idle one is dropped first. Chat requests without one are stateless and
+    are answered from the messages they carry.
+    """
+    def __init__(self, llama_cpp, config: dict):
+        server_config = config.get("server", {})
+        self.llama_cpp = llama_cpp
+        self.config = config
+        self.host = server_config.get("host", "127.0.0.1")
+        self.port = server_config.get("port", 8080)
+        self.max_queue = server_config.get("max_queue", 16)
+        self.max_session_queue = server_config.get("max_session_queue", 4)
+        self.max_sessions = server_config.get("max_sessions", 64)
+        self.model_name = config["model_path"].replace("\\", "/").split("/")[-1]
+        self.chat_logger = conversation_logger_from_config(config)
+        self.token_budget = history_token_budget(llama_cpp, config)
+        self.token_threshold = summary_token_threshold(self.token_budget)
+        self.sessions = OrderedDict()                           # session_id -> ServerSession, least recently used first
+        self.pending = OrderedDict()                            # session_id -> deque of queued jobs
+        self.jobs = {}                                          # job id -> queued or running job
+        self.n_pending = 0
+        self.active = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = None
+        self.wakeup = None
+
+    # ---------------- scheduling ----------------
+    def enqueue(self, job: Job) -> bool:
+        queue = self.pending.setdefault(job.queue_key, deque())
+        if self.n_pending >= self.max_queue or len(queue) >= self.max_session_queue:
+            if not queue:
+                del self.pending[job.queue_key]
+            return False
+        queue.append(job)
+        self.jobs[job.id] = job
+        self.n_pending += 1
+        self.wakeup.set()
+        logging.debug("Server -> Queued %s for session %s. Queue depth: %d", job.id, job.session_id, self.n_pending)
+        return True
+
+    def next_job(self):
+        """Takes the oldest job of the next session in round-robin order."""
+        queue_key, queue = self.pending.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            self.pending[queue_key] = queue
+        self.n_pending -= 1
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled.set()
+        queue = self.pending.get(job.queue_key)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self.pending[job.queue_key]
+            self.n_pending -= 1
+            self.finish(job, "cancelled")
+        return True
+
+    def session(self, session_id: str) -> ServerSession:
+        """Returns the session, creating it if needed, and drops the least recently used idle sessions over max_sessions."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = ServerSession(self.llama_cpp, self.config, self.token_budget, self.token_threshold)
+        self.sessions.move_to_end(session_id)
+        busy = set(self.pending) | ({self.active.queue_key} if self.active else set())
+        for idle_id in [sid for sid in self.sessions if sid not in busy and sid != session_id][:max(len(self.sessions) - self.max_sessions, 0)]:
+            del self.sessions[idle_id]
+            logging.debug("Server -> Dropped idle session %s", idle_id)
+        return session
+
+    def finish(self, job: Job, finish_reason: str):
+        job.finish_reason = finish_reason
+        self.jobs.pop(job.id, None)
+        job.tokens.put_nowait(None)
+
+    async def scheduler(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            job = self.next_job()
+            self.active = job
+            try:
+                finish_reason = await self.loop.run_in_executor(self.executor, self.run_job, job)
+            except Exception:
+                logging.exception("Server request %s failed", job.id)
+                finish_reason = "error"
+            self.active = None
+            self.finish(job, finish_reason)
+
+    # ---------------- generation (worker thread) ----------------
+    def run_job(self, job: Job) -> str:
+        body = job.body
+        params = sampling_params(self.config)
+        params.update({key: body[key] for key in params if body.get(key) is not None})
+        max_tokens = body.get("max_tokens") or self.config["max_tokens"]
+
+        session = job.session
+        if job.kind == "chat":
+            user_input = last_user_message(body.get("messages", []))
+            if session is not None:
+                session.summary, _, _, _ = session.summarizer.prepare_turn(self.llama_cpp, session.chat_history, session.summary, user_input)
+                chat, prompt = session.chat, session.chat.build_prompt(session.summary, session.chat_history, user_input)
+            else:
+                chat, prompt = self.stateless_prompt(body["messages"])
+            reused_tokens, evaluated_tokens = chat.prefix_stats(prompt)
+            job.usage["prompt_tokens"] = reused_tokens + evaluated_tokens
+            logging.info(f"Server -> {job.id} session {job.session_id or '(stateless)'}. Prompt cache reused: {reused_tokens} tokens. Evaluated: {evaluated_tokens} tokens\n")
+        else:
+            prompt = body.get("prompt", "")
+            job.usage["prompt_tokens"] = len(self.llama_cpp.tokenize(prompt.encode("utf-8"), special=True))
+
+        pieces = []
+        finish_reason = "stop"
+        start_time = time.perf_counter()
+        for chunk in self.llama_cpp(prompt=prompt, max_tokens=max_tokens, stream=True, **params):
+            if job.cancelled.is_set():
+                finish_reason = "cancelled"
+                break
+            choice = chunk.get("choices", [{}])[0]
+            text = choice.get("text", "")
+            if not pieces:
+                text = text.lstrip() if job.kind == "chat" else text
+            if text:
+                pieces.append(text)
+                self.loop.call_soon_threadsafe(job.tokens.put_nowait, text)
+            job.usage["completion_tokens"] += 1
+            finish_reason = choice.get("finish_reason") or finish_reason
+        job.usage["total_tokens"] = job.usage["prompt_tokens"] + job.usage["completion_tokens"]
+        elapsed = time.perf_counter() - start_time
+        logging.info(f"Server -> {job.id} finished ({finish_reason}). Tokens: {job.usage['completion_tokens']}. Speed: {job.usage['completion_tokens'] / elapsed if elapsed > 0 else 0.0:.2f} tokens/s\n")
+
+        if job.kind == "chat" and finish_reason != "cancelled":
+            answer = "".join(pieces).strip()
+            if session is not None:
+                session.chat_history.append(f"User: {user_input}")
+                session.chat_history.append(f"Assistant: {answer}")
+            self.chat_logger.log(user_input, answer)
+        return finish_reason
+
+    def stateless_prompt(self, messages: list) -> tuple:
+        """
+        (ChatSession, prompt) for a chat request without a session: system messages replace the system prompt and
+        the turns before the last user message become the history, oldest dropped first to fit the token budget.
+        """
+        last_user = max(i for i, message in enumerate(messages) if isinstance(message, dict) and message.get("role") == "user")
+        system_prompt = "\n".join(str(m.get("content", "")) for m in messages if isinstance(m, dict) and m.get("role") == "system")
+        chat = ChatSession(self.llama_cpp, self.config["prompt_template"], system_prompt or self.config["system_prompt"], append_only=self.config.get("kv_cache_reuse", True))
+        chat_history = ChatHistory(self.llama_cpp, user_overhead=chat.turn_overhead())
+        for message in messages[:last_user]:
+            if isinstance(message, dict) and message.get("role") in ("user", "assistant"):
+                chat_history.append(f"{message['role'].capitalize()}: {str(message.get('content', '')).strip()}")
+        while chat_history and chat_history.total_tokens > self.token_budget:
+            chat_history.drop_oldest(1)
+        return chat, chat.build_prompt("", chat_history, last_user_message(messages))
+
+    # ---------------- HTTP ----------------
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await read_request(reader)
+            await self.route(method, path, body, writer)
+        except ValueError as e:
+            await write_json(writer, 400, error_body(str(e), "invalid_request_error"))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.exception("Unhandled exception in server request")
+            await write_json(writer, 500, error_body(str(e), "server_error"))
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: dict, writer):
+        if path == "/health":
+            active = self.active.id if self.active else None
+            return await write_json(writer, 200, {"status": "ok", "queue_depth": self.n_pending, "active": active, "sessions": len(self.sessions)})
+        if path == "/v1/models":
+            return await write_json(writer, 200, {"object": "list", "data": [{"id": self.model_name, "object": "model", "owned_by": "local"}]})
+        if path.startswith("/v1/requests/"):
+            if method != "DELETE":
+                return await write_json(writer, 405, error_body("Use DELETE to cancel a request", "invalid_request_error"))
+            job_id = path.rsplit("/", 1)[-1]
+            if not self.cancel(job_id):
+                return await write_json(writer, 404, error_body(f"No queued or running request {job_id}", "invalid_request_error"))
+            return await write_json(writer, 200, {"id": job_id, "object": "request.cancelled"})
+        if path in ("/v1/completions", "/v1/chat/completions"):
+            if method != "POST":
+                return await write_json(writer, 405, error_body("Use POST", "invalid_request_error"))
+            return await self.complete(path, body, writer)
+        await write_json(writer, 404, error_body(f"Unknown path {path}", "invalid_request_error"))
+
+    async def complete(self, path: str, body: dict, writer):
+        kind = "chat" if path == "/v1/chat/completions" else "text"
+        session_id = body.get("session_id") or body.get("user")
+        session_id = str(session_id) if session_id else None
+        if kind == "chat":
+            if not isinstance(body.get("messages"), list) or not last_user_message(body["messages"]):
+                raise ValueError("messages must contain a user message")
+        elif not isinstance(body.get("prompt"), str):
+            raise ValueError("prompt must be a string")
+        validate_params(body)
+
+        job = Job(kind, session_id, body)
+        if not self.enqueue(job):
+            return await write_json(writer, 429, error_body("Too many queued requests, retry later", "rate_limit_error"), {"Retry-After": "1"})
+        if kind == "chat" and session_id:
+            job.session = self.session(session_id)               # before the next await, so the job never runs without it
+
+        try:
+            if body.get("stream"):
+                await self.stream_response(job, writer)
+            else:
+                await self.full_response(job, writer)
+        except ConnectionError:
+            self.cancel(job.id)
+            raise
+
+    async def stream_response(self, job: Job, writer):
+        writer.write(response_head(200, "text/event-stream", {"Cache-Control": "no-cache", "X-Request-Id": job.id}))
+        await writer.drain()
+        while True:
+            text = await job.tokens.get()
+            if text is None:
+                break
+            writer.write(sse(self.chunk(job, text, None)))
+            await writer.drain()
+        writer.write(sse(self.chunk(job, "", job.finish_reason)))
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    async def full_response(self, job: Job, writer):
+        pieces = []
+        while True:
+            text = await job.tokens.get()
+            if text is None:
+                break
+            pieces.append(text)
+        text = "".join(pieces)
+        if job.kind == "chat":
+            choice = {"index": 0, "message": {"role": "assistant", "content": text.strip()}, "finish_reason": job.finish_reason}
+            obj = "chat.completion"
+        else:
+            choice = {"index": 0, "text": text, "finish_reason": job.finish_reason}
+            obj = "text_completion"
+        await write_json(writer, 200, {"id": job.id, "object": obj, "created": job.created, "model": self.model_name, "choices": [choice], "usage": job.usage}, {"X-Request-Id": job.id})
+
+    def chunk(self, job: Job, text: str, finish_reason) -> dict:
+        if job.kind == "chat":
+            choice = {"index": 0, "delta": {"content": text} if text else {}, "finish_reason": finish_reason}
+            obj = "chat.completion.chunk"
+        else:
+            choice = {"index": 0, "text": text, "finish_reason": finish_reason}
+            obj = "text_completion"
+        return {"id": job.id, "object": obj, "created": job.created, "model": self.model_name, "choices": [choice]}
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        scheduler_task = asyncio.create_task(self.scheduler())
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print_system(f"[Server] Serving {self.model_name} on http://{self.host}:{self.port} (max queue {self.max_queue}, {self.max_session_queue} per session).")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            scheduler_task.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+# ==========================================================
+#                      HTTP HELPERS
+# ==========================================================
+NUMBER_PARAMS = {"temperature": (0.0, None), "top_p": (0.0, 1.0), "frequency_penalty": (-2.0, 2.0), "presence_penalty": (-2.0, 2.0), "repeat_penalty": (0.0, None)}
+
+def validate_params(body: dict):
+    """Rejects malformed generation parameters with a ValueError (answered with 400) before the request is queued."""
+    max_tokens = body.get("max_tokens")
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1):
+        raise ValueError("max_tokens must be a positive integer")
+    for key, (low, high) in NUMBER_PARAMS.items():
+        value = body.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f"{key} must be a number")
+        if value < low or (high is not None and value > high):
+            raise ValueError(f"{key} must be between {low} and {high}" if high is not None else f"{key} must be at least {low}")
+    top_k = body.get("top_k")
+    if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 0):
+        raise ValueError("top_k must be a non-negative integer")
+    stop = body.get("stop")
+    if stop is not None and not isinstance(stop, str) and not (isinstance(stop, list) and all(isinstance(s, str) for s in stop)):
+        raise ValueError("stop must be a string or a list of strings")
+    if not isinstance(body.get("stream", False), bool):
+        raise ValueError("stream must be a boolean")
+
+def last_user_message(messages: list) -> str:
+    for message in reversed(messages):
+        if isinstance(message, dict) and message.get("role") == "user":
+            return str(message.get("content", "")).strip()
+    return ""
+
+async def read_request(reader) -> tuple:
+    request_line = await reader.readline()
+    if not request_line:
+        raise ConnectionError("Client closed the connection")
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ValueError("Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    raw_body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+    try:
+        body = json.loads(raw_body) if raw_body else {}
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Request body is not valid JSON: {e}")
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a JSON object")
+    return method.upper(), target.split("?", 1)[0], body
+
+def response_head(status: int, content_type: str, headers: dict = None, content_length: int = None) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}", f"Content-Type: {content_type}", "Connection: close"]
+    if content_length is not None:
+        lines.append(f"Content-Length: {content_length}")
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+async def write_json(writer, status: int, payload: dict, headers: dict = None):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    writer.write(response_head(status, "application/json", headers, len(data)) + data)
+    await writer.drain()
+
+def sse(payload: dict) -> bytes:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+def error_body(message: str, error_type: str) -> dict:
+    return {"error": {"message": message, "type": error_type}}
+
+def serve(llama_cpp, config: dict):
+    try:
+        asyncio.run(ComfyServer(llama_cpp, config).run())
+    except KeyboardInterrupt:
+        print_system("\n[Server] Stopped.")
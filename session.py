@@ -0,0 +1,313 @@
+import os
+import re
+import json
+import mmap
+import shutil
+import time
+import logging
+import numpy as np
+from contextlib import contextmanager
+from utils import format_prompt, concat_chat_history, format_memories, count_tokens
+
+# ==========================================================
+#                  PROMPT / SESSION STATE
+# ==========================================================
+class ChatSession:
+    """
+    Assembles chat prompts so the text llama.cpp has already evaluated stays a stable, append-only prefix.
+
+    The prompt template is split at {chat_history}: everything before it (system prompt and context header)
+    is the fixed head, and everything after it is rendered once per turn. A finished turn is rendered exactly
+    as it was sent to the model plus the answer, so the next prompt only adds new tokens at the end.
+    """
+    def __init__(self, llama_cpp, prompt_template: str, system_prompt: str, append_only: bool = True):
+        self.llama_cpp = llama_cpp
+        self.prompt_template = prompt_template
+        self.system_prompt = system_prompt
+        self.saved_state = None
+        self.stable_text = ""                                   # head + history of the last built prompt
+        self.prefix_text = ""                                   # text already tokenized into prefix_ids
+        self.prefix_ids = []
+
+        head, found, tail = prompt_template.partition("{chat_history}")
+        self.append_only = append_only and bool(found) and "{user_input}" in tail
+        if self.append_only:
+            self.head = head.format(system_prompt=system_prompt)
+            self.turn_template = tail
+        elif append_only:
+            logging.warning("Prompt template has no {chat_history}/{user_input} split, KV-cache prefix reuse is limited.")
+
+    def render_history(self, summary: str, chat_history: list) -> str:
+        """
+        Renders the summary and chat history the same way they were laid out when first evaluated.
+        """
+        if not self.append_only:
+            return (summary + "\n\n" + concat_chat_history(chat_history)).strip()
+
+        parts = [summary.strip()]
+        after_user = False
+        for entry in chat_history:
+            role, _, text = entry.partition(": ")
+            if role == "User":
+                parts.append(self.turn_template.format(user_input=text))
+                after_user = True
+            elif role == "Assistant" and after_user:
+                parts.append(" " + text)
+                after_user = False
+            else:
+                parts.append("\n" + entry)
+                after_user = False
+        return "".join(parts)
+
+    def turn_overhead(self) -> int:
+        """
+        Extra tokens a "User: x" / "Assistant: y" pair costs when rendered through the turn template,
+        compared to counting the two messages plainly the way ChatHistory does.
+        """
+        if not self.append_only:
+            return 0
+        rendered = count_tokens(self.llama_cpp, self.turn_template.format(user_input="x") + " y")
+        plain = count_tokens(self.llama_cpp, "User: x") + count_tokens(self.llama_cpp, "Assistant: y") + 1
+        return max(rendered - plain, 0)
+
+    def build_prompt(self, summary: str, chat_history: list, user_input: str, memories: list = ()) -> str:
+        """
+        Recalled memories change every turn, so they go after the history, right before the current turn. They are
+        not kept in the history, so the next prompt diverges from the evaluated one where this turn's memory block
+        was and the whole previous turn is re-evaluated; everything before it is still reused.
+        """
+        if not self.append_only:
+            return format_prompt(
+                prompt_template=self.prompt_template,
+                system_prompt=self.system_prompt,
+                chat_history=self.render_history(summary, chat_history) + format_memories(memories),
+                user_input=user_input
+            )
+        self.stable_text = self.head + self.render_history(summary, chat_history)
+        return self.stable_text + format_memories(memories) + self.turn_template.format(user_input=user_input)
+
+    def prompt_tokens(self, prompt: str) -> list:
+        """
+        Token ids of prompt, tokenizing only what was appended since the last call: the stable head + history part
+        extends the previously tokenized one, so only the new turn and the text after it are tokenized.
+        Pieces are tokenized separately, so ids at a piece boundary can differ slightly from a full tokenize.
+        """
+        stable = self.stable_text if self.stable_text and prompt.startswith(self.stable_text) else ""
+        if not stable:
+            return self.llama_cpp.tokenize(prompt.encode("utf-8"), special=True)
+        if self.prefix_text and stable.startswith(self.prefix_text):
+            ids = self.prefix_ids + self.llama_cpp.tokenize(stable[len(self.prefix_text):].encode("utf-8"), add_bos=False, special=True)
+        else:
+            ids = self.llama_cpp.tokenize(stable.encode("utf-8"), special=True)
+        self.prefix_text, self.prefix_ids = stable, ids
+        return ids + self.llama_cpp.tokenize(prompt[len(stable):].encode("utf-8"), add_bos=False, special=True)
+
+    def prefix_stats(self, prompt: str) -> tuple:
+        """
+        Returns (reused, evaluated) prompt token counts against the tokens currently held in the Llama context.
+        Mirrors the prefix match Llama.generate does against input_ids[:n_tokens], which always re-evaluates
+        at least the last prompt token.
+        """
+        tokens = self.prompt_tokens(prompt)
+        cached = np.asarray(self.llama_cpp.input_ids[:self.llama_cpp.n_tokens])
+        candidate = np.asarray(tokens[:-1][:len(cached)])
+        mismatches = np.flatnonzero(cached[:len(candidate)] != candidate)
+        reused = int(mismatches[0]) if len(mismatches) else len(candidate)
+        return reused, len(tokens) - reused
+
+    def snapshot(self):
+        if self.llama_cpp.n_tokens == 0:
+            self.saved_state = None
+            return
+        self.saved_state = self.llama_cpp.save_state()
+
+    def restore(self):
+        if self.saved_state is not None:
+            self.llama_cpp.load_state(self.saved_state)
+            self.saved_state = None
+
+    @contextmanager
+    def preserve_state(self):
+        """
+        Runs one-off prompts (e.g. /joke) without throwing away the evaluated conversation in the KV cache.
+        """
+        self.snapshot()
+        try:
+            yield
+        finally:
+            self.restore()
+
+# ==========================================================
+#                  PERSISTENT SESSIONS
+# ==========================================================
+SESSION_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class SessionStore:
+    """
+    Keeps named conversations on disk so they can be resumed without re-evaluating the prompt.
+
+    Each session is a directory holding session.json (history, summary and snapshot metadata), tokens.npy
+    (the evaluated token ids, padded back to n_ctx on load) and kv_state.bin (llama.cpp's raw context state). Logits are not stored since
+    Llama.generate always re-evaluates the last prompt token; both binary files are memory-mapped when loaded.
+    session.json is written last, so a snapshot only counts once it is complete. When the store grows past
+    max_bytes, the KV snapshots of the least recently saved sessions are dropped and their text is kept.
+    """
+    def __init__(self, llama_cpp, config: dict, sessions_dir: str = "sessions", max_bytes: int = 4 * 1024**3):
+        self.llama_cpp = llama_cpp
+        self.fingerprint = {"model_path": config["model_path"], "n_ctx": config["n_ctx"], "prompt_template": config["prompt_template"], "system_prompt": config["system_prompt"]}
+        self.sessions_dir = sessions_dir
+        self.max_bytes = max_bytes
+        os.makedirs(sessions_dir, exist_ok=True)
+
+    def path(self, name: str, filename: str = "") -> str:
+        if not SESSION_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid session name '{name}' (use letters, digits, '-' and '_')")
+        return os.path.join(self.sessions_dir, name, filename)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name, "session.json"))
+
+    def read_meta(self, name: str) -> dict:
+        with open(self.path(name, "session.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_meta(self, name: str, meta: dict):
+        path = self.path(name, "session.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def save(self, name: str, chat_history: list, summary: str, save_kv: bool = True) -> dict:
+        """
+        Writes the conversation and, if the context holds evaluated tokens, its KV state. Returns the metadata.
+        """
+        start_time = time.perf_counter()
+        os.makedirs(self.path(name), exist_ok=True)
+        kv = None
+        if save_kv and self.llama_cpp.n_tokens > 0:
+            state = self.llama_cpp.save_state()
+            tokens_path = self.path(name, "tokens.npy")
+            kv_path = self.path(name, "kv_state.bin")
+            with open(tokens_path + ".tmp", "wb") as f:
+                np.save(f, np.asarray(state.input_ids[:state.n_tokens], dtype=np.intc))
+            with open(kv_path + ".tmp", "wb") as f:
+                f.write(memoryview(state.llama_state)[:state.llama_state_size])
+            os.replace(tokens_path + ".tmp", tokens_path)
+            os.replace(kv_path + ".tmp", kv_path)
+            kv = {"n_tokens": state.n_tokens, "state_size": state.llama_state_size, "scores_shape": list(state.scores.shape), "seed": state.seed}
+        else:
+            self.drop_kv(name)
+
+        meta = {"name": name, "saved_at": time.time(), **self.fingerprint, "summary": summary, "chat_history": list(chat_history), "kv": kv}
+        self.write_meta(name, meta)
+        logging.debug("Sessions -> Saved '%s' (%d messages, %s KV tokens) in %.2fs", name, len(chat_history), kv["n_tokens"] if kv else "no", time.perf_counter() - start_time)
+        self.evict(keep=name)
+        return meta
+
+    def load(self, name: str) -> tuple:
+        """
+        Reads a session and restores its KV state into the context if the snapshot matches the loaded model.
+        Returns (chat_history messages, summary, restored) where restored tells whether the KV state was loaded.
+        """
+        from llama_cpp import LlamaState
+        start_time = time.perf_counter()
+        meta = self.read_meta(name)
+        kv = meta.get("kv")
+        restored = False
+        if kv and all(meta.get(key) == value for key, value in self.fingerprint.items()):
+            try:
+                tokens = np.load(self.path(name, "tokens.npy"), mmap_mode="r")
+                with open(self.path(name, "kv_state.bin"), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as llama_state:
+                    if len(llama_state) != kv["state_size"] or len(tokens) != kv["n_tokens"]:
+                        raise ValueError("snapshot files do not match session.json")
+                    input_ids = np.zeros(self.llama_cpp.n_ctx(), dtype=np.intc)   # Llama.eval writes into the full n_ctx buffer
+                    input_ids[:kv["n_tokens"]] = tokens
+                    self.llama_cpp.load_state(LlamaState(
+                        input_ids=input_ids,
+                        scores=np.zeros(kv["scores_shape"], dtype=np.single),
+                        n_tokens=kv["n_tokens"],
+                        llama_state=llama_state,
+                        llama_state_size=kv["state_size"],
+                        seed=kv["seed"]
+                    ))
+                del tokens
+                restored = True
+            except Exception as e:
+                logging.warning(f"Could not restore the KV snapshot of session '{name}', the prompt will be re-evaluated: {e}")
+                self.llama_cpp.reset()
+        elif kv:
+            logging.debug("Sessions -> Snapshot of '%s' was made with a different model or prompt, not restoring KV state", name)
+        logging.debug("Sessions -> Loaded '%s' (%d messages, KV %s) in %.2fs", name, len(meta["chat_history"]), "restored" if restored else "not restored", time.perf_counter() - start_time)
+        return meta["chat_history"], meta.get("summary", ""), restored
+
+    def drop_kv(self, name: str) -> int:
+        """Deletes a session's KV snapshot but keeps its conversation. Returns the bytes freed."""
+        freed = 0
+        for filename in ("tokens.npy", "kv_state.bin"):
+            path = self.path(name, filename)
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        if freed and self.exists(name):
+            meta = self.read_meta(name)
+            meta["kv"] = None
+            self.write_meta(name, meta)
+        return freed
+
+    def delete(self, name: str) -> bool:
+        """Removes a saved session with its snapshot. Returns whether there was one."""
+        if not os.path.isdir(self.path(name)):
+            return False
+        shutil.rmtree(self.path(name))
+        logging.debug("Sessions -> Deleted '%s'", name)
+        return True
+
+    def list_sessions(self) -> list:
+        """Metadata of every saved session (without the history text), most recently saved first."""
+        sessions = []
+        for name in os.listdir(self.sessions_dir):
+            if not SESSION_NAME_PATTERN.match(name) or not self.exists(name):
+                continue
+            meta = self.read_meta(name)
+            sessions.append({
+                "name": name,
+                "saved_at": meta["saved_at"],
+                "messages": len(meta["chat_history"]),
+                "kv_tokens": meta["kv"]["n_tokens"] if meta.get("kv") else 0,
+                "bytes": dir_size(self.path(name)),
+            })
+        return sorted(sessions, key=lambda s: s["saved_at"], reverse=True)
+
+    def evict(self, keep: str = None):
+        """Drops the oldest KV snapshots (never keep's) until the store fits in max_bytes."""
+        if not self.max_bytes:
+            return
+        sessions = self.list_sessions()
+        total = sum(s["bytes"] for s in sessions)
+        for s in reversed(sessions):
+            if total <= self.max_bytes:
+                break
+            if s["name"] == keep or not s["kv_tokens"]:
+                continue
+            freed = self.drop_kv(s["name"])
+            total -= freed
+            logging.debug("Sessions -> Evicted KV snapshot of '%s' (%.1f MB)", s["name"], freed / (1024 * 1024))
+
+def session_store_from_config(llama_cpp, config: dict) -> SessionStore:
+    session_config = config.get("sessions", {})
+    return SessionStore(
+        llama_cpp,
+        config,
+        sessions_dir=session_config.get("dir", "sessions"),
+        max_bytes=int(session_config.get("max_disk_mb", 4096) * 1024 * 1024)
+    )
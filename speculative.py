@@ -0,0 +1,107 @@
+import time
+import logging
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+from utils import sampling_params
+
+# ==========================================================
+#                      DRAFT MODELS
+# ==========================================================
+class GGUFDraftModel(LlamaDraftModel):
+    """
+    Drafts tokens greedily with a small GGUF model that shares the main model's vocabulary.
+    Llama.generate reuses the draft model's KV prefix, so each call only evaluates the newly accepted tokens.
+    """
+    def __init__(self, model_path: str, num_pred_tokens: int = 10, n_ctx: int = 4096, n_gpu_layers: int = 0, n_threads: int = None):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_gpu_layers=n_gpu_layers, n_threads=n_threads, verbose=False)
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft = []
+        for token in self.llm.generate(list(input_ids), top_k=1, temp=0.0, reset=True):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+class CountingDraftModel(LlamaDraftModel):
+    """
+    Wraps a draft model and counts verification steps and proposed tokens.
+    Every step ends with one token sampled by the main model, so accepted drafts = generated tokens - steps.
+    """
+    def __init__(self, draft_model: LlamaDraftModel):
+        self.draft_model = draft_model
+        self.enabled = True
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.steps = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids, /, **kwargs):
+        if not self.enabled:
+            return np.array([], dtype=np.intc)
+        draft = self.draft_model(input_ids, **kwargs)
+        self.steps += 1
+        self.proposed += len(draft)
+        return draft
+
+    def acceptance(self, completion_tokens: int) -> tuple:
+        """Returns (accepted, proposed, rate) for the generation since the last reset_counts()."""
+        accepted = min(max(completion_tokens - self.steps, 0), self.proposed)
+        return accepted, self.proposed, accepted / self.proposed if self.proposed else 0.0
+
+def build_draft_model(config: dict) -> CountingDraftModel:
+    """
+    Creates the draft model selected by the speculative config block, or None when speculative decoding is off.
+    The main model must then be loaded with logits_all=True, which allocates an n_ctx x n_vocab float32 logits
+    buffer and makes every save_state() snapshot (/joke, variant pool, /save) correspondingly larger.
+    """
+    spec_config = config.get("speculative", {})
+    mode = spec_config.get("mode", "off")
+    num_pred_tokens = spec_config.get("num_pred_tokens", 10)
+    if mode == "prompt_lookup":
+        draft_model = LlamaPromptLookupDecoding(max_ngram_size=spec_config.get("max_ngram_size", 2), num_pred_tokens=num_pred_tokens)
+    elif mode == "draft_model":
+        draft_model = GGUFDraftModel(
+            spec_config["draft_model_path"],
+            num_pred_tokens=num_pred_tokens,
+            n_ctx=config["n_ctx"],
+            n_gpu_layers=spec_config.get("draft_n_gpu_layers", config["n_gpu_layers"]),
+            n_threads=config["n_threads"]
+        )
+    elif mode == "off":
+        return None
+    else:
+        raise ValueError(f"Unknown speculative mode '{mode}' (expected off, prompt_lookup or draft_model)")
+    logging.debug("Speculative decoding: %s, %d draft tokens per step", mode, num_pred_tokens)
+    return CountingDraftModel(draft_model)
+
+# ==========================================================
+#                    SPEEDUP MEASUREMENT
+# ==========================================================
+def decode_speed(llama_cpp, prompt: str, config: dict, max_tokens: int) -> float:
+    """Tokens/sec after the first token for a silent streamed generation, measured like generate_response does."""
+    first_token_time = None
+    n_tokens = 0
+    for _ in llama_cpp(prompt=prompt, max_tokens=max_tokens, stream=True, **sampling_params(config)):
+        n_tokens += 1
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+    if first_token_time is None:
+        return 0.0
+    elapsed = time.perf_counter() - first_token_time
+    return n_tokens / elapsed if elapsed > 0 else 0.0
+
+def measure_speedup(llama_cpp, draft_model: CountingDraftModel, prompt: str, config: dict, max_tokens: int, speculative_tps: float) -> float:
+    """
+    Replays prompt with drafting disabled and returns speculative / plain decode speed.
+    The caller should preserve the KV state around this, since the replay overwrites it.
+    """
+    draft_model.enabled = False
+    try:
+        plain_tps = decode_speed(llama_cpp, prompt, config, max_tokens)
+    finally:
+        draft_model.enabled = True
+    return speculative_tps / plain_tps if plain_tps > 0 else 0.0
@@ -0,0 +1,114 @@
+import os
+import re
+import sys
+import zlib
+import types
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ==========================================================
+#              LLAMA-CPP-PYTHON STATE MIRROR
+# ==========================================================
+class LlamaState:
+    """Same fields as llama_cpp.LlamaState."""
+    def __init__(self, input_ids, scores, n_tokens, llama_state, llama_state_size, seed):
+        self.input_ids = input_ids
+        self.scores = scores
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = llama_state_size
+        self.seed = seed
+
+try:
+    import llama_cpp
+except ImportError:
+    llama_cpp = types.ModuleType("llama_cpp")
+    llama_cpp.LlamaState = LlamaState
+    sys.modules["llama_cpp"] = llama_cpp
+
+class MirrorLlama:
+    """
+    Mirrors how llama-cpp-python 0.3.x keeps its buffers: input_ids is a fixed n_ctx array and scores has
+    n_ctx rows with logits_all or n_batch rows without. eval(), save_state(), load_state() and the prefix
+    match in generate() follow the library, so shape mistakes fail here the way they fail on a real model.
+    The "KV state" is the evaluated token ids as bytes, which lets tests check that a restore is exact.
+    """
+    def __init__(self, n_ctx: int = 256, n_batch: int = 16, n_vocab: int = 8, logits_all: bool = False):
+        self._n_ctx = n_ctx
+        self.n_batch = n_batch
+        self._n_vocab = n_vocab
+        self._logits_all = logits_all
+        self.input_ids = np.ndarray((n_ctx,), dtype=np.intc)
+        self.scores = np.ndarray((n_ctx if logits_all else n_batch, n_vocab), dtype=np.single)
+        self.n_tokens = 0
+        self._seed = 0
+        self.evaluated = 0
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    @property
+    def _scores(self):
+        return self.scores[:self.n_tokens, :]
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        ids = [zlib.crc32(piece) % 30000 + 3 for piece in re.findall(rb"\w+|[^\w\s]", text)]
+        return ([1] if add_bos else []) + ids
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: list):
+        for i in range(0, len(tokens), self.n_batch):
+            batch = tokens[i:i + self.n_batch]
+            n_past = self.n_tokens
+            n_tokens = len(batch)
+            if self._logits_all:
+                self.scores[n_past:n_past + n_tokens, :] = 0.0
+            self.input_ids[n_past:n_past + n_tokens] = batch
+            self.n_tokens += n_tokens
+            self.evaluated += n_tokens
+
+    def generate(self, tokens: list, max_tokens: int = 4):
+        if self.n_tokens > 0:
+            longest_prefix = 0
+            for a, b in zip(self._input_ids, tokens[:-1]):
+                if a != b:
+                    break
+                longest_prefix += 1
+            tokens = tokens[longest_prefix:]
+            self.n_tokens = longest_prefix
+        generated = []
+        while len(generated) < max_tokens:
+            self.eval(tokens)
+            token = int(sum(self._input_ids)) % 30000 + 3
+            generated.append(token)
+            tokens = [token]
+        return generated
+
+    def save_state(self) -> LlamaState:
+        llama_state = self._input_ids.tobytes()
+        return LlamaState(
+            scores=self._scores.copy(),
+            input_ids=self.input_ids.copy(),
+            n_tokens=self.n_tokens,
+            llama_state=llama_state,
+            llama_state_size=len(llama_state),
+            seed=self._seed,
+        )
+
+    def load_state(self, state: LlamaState):
+        self.scores[:state.n_tokens, :] = state.scores.copy()
+        rest = self.scores[state.n_tokens:, :]
+        rest[rest > 0] = 0.0
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = state.n_tokens
+        self._seed = state.seed
+        kv = np.frombuffer(bytes(state.llama_state[:state.llama_state_size]), dtype=np.intc)
+        if not np.array_equal(kv, self._input_ids):
+            raise RuntimeError("Failed to set llama state data")
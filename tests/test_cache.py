@@ -0,0 +1,107 @@
+import time
+import pytest
+import cache
+from conftest import MirrorLlama
+from cache import ResponseCache, ModelGuard, VariantPool
+from session import ChatSession
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+def test_variants_are_taken_in_order():
+    responses = ResponseCache()
+    for text in ("one", "two", "three"):
+        responses.add("joke", text, max_variants=2)
+    assert responses.count("joke") == 2
+    assert responses.peek("joke") == "one"
+    assert [responses.take("joke"), responses.take("joke"), responses.take("joke")] == ["one", "two", None]
+    assert responses.hits == 3 and responses.misses == 1
+
+def test_lru_keeps_recently_used_entries():
+    responses = ResponseCache(memory_entries=2)
+    responses.add("a", "A")
+    responses.add("b", "B")
+    responses.peek("a")
+    responses.add("c", "C")
+    assert list(responses.memory) == ["a", "c"]
+    assert responses.peek("b") is None
+
+def test_ttl_is_not_reset_by_take_or_add(clock):
+    responses = ResponseCache(ttl=60)
+    responses.add("joke", "one", max_variants=3)
+    clock.now += 40
+    responses.add("joke", "two", max_variants=3)
+    assert responses.take("joke") == "one"
+    clock.now += 30
+    assert responses.take("joke") is None
+
+def test_disk_hit_keeps_remaining_lifetime(tmp_path):
+    pytest.importorskip("diskcache")
+    responses = ResponseCache(ttl=60, disk_path=str(tmp_path))
+    responses.add("joke", "one")
+    expires_at = responses.memory["joke"][0]
+    responses.close()
+
+    reopened = ResponseCache(ttl=60, disk_path=str(tmp_path))
+    assert reopened.peek("joke") == "one"
+    assert reopened.memory["joke"][0] == pytest.approx(expires_at, abs=1.0)
+    reopened.close()
+
+class StreamingLlama(MirrorLlama):
+    """MirrorLlama with the streaming __call__ VariantPool uses; it evaluates the prompt and one token per chunk."""
+    def __init__(self, on_chunk=None, **kwargs):
+        super().__init__(**kwargs)
+        self.on_chunk = on_chunk
+
+    def __call__(self, prompt: str, max_tokens: int = 4, stream: bool = True, **kwargs):
+        self.reset()
+        self.eval(self.tokenize(prompt.encode("utf-8")))
+        for i in range(max_tokens):
+            if self.on_chunk:
+                self.on_chunk(i)
+            self.eval([3 + i])
+            yield {"choices": [{"text": f" w{i}"}]}
+
+def test_preempted_generation_restores_the_conversation():
+    guard = ModelGuard()
+    llm = StreamingLlama(on_chunk=lambda i: i == 2 and guard.foreground_waiting.set())
+    session = ChatSession(llm, "{system_prompt}\n{chat_history}\nUser: {user_input}\nAssistant:", "You are a cat.")
+    llm.eval(llm.tokenize(b"the evaluated conversation"))
+    before = list(llm._input_ids)
+
+    pool = VariantPool(llm, ResponseCache(), guard, session, pool_size=1)
+    assert pool._generate("Tell me a joke", 8, {}) is None
+    assert list(llm._input_ids) == before
+
+    guard.foreground_waiting.clear()
+    llm.on_chunk = None
+    assert pool._generate("Tell me a joke", 3, {}) == "w0 w1 w2"
+    assert list(llm._input_ids) == before
+
+def test_prefill_pools_every_prompt_without_a_take():
+    guard = ModelGuard()
+    llm = StreamingLlama()
+    session = ChatSession(llm, "{system_prompt}\n{chat_history}\nUser: {user_input}\nAssistant:", "You are a cat.")
+    responses = ResponseCache()
+    pool = VariantPool(llm, responses, guard, session, pool_size=2)
+    pool.register("joke", "Tell me a joke", 2, {})
+    pool.register("story", "Tell me a story", 2, {})
+    assert pool.thread is None
+
+    pool.prefill()
+    deadline = time.monotonic() + 5
+    while (responses.count("joke") < 2 or responses.count("story") < 2) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert responses.count("joke") == 2 and responses.count("story") == 2
+    with guard.foreground():
+        assert pool.take("joke") == "w0 w1"
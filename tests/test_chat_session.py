@@ -0,0 +1,32 @@
+from conftest import MirrorLlama
+from session import ChatSession
+from test_session_store import CONFIG, chat_turn
+
+def test_prefix_stats_ignores_stale_buffer_entries():
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    prompt = session.build_prompt("", [], "hello there")
+    tokens = llm.tokenize(prompt.encode("utf-8"), special=True)
+    llm.eval(tokens)
+    llm.n_tokens = 3                                            # the rest of input_ids is now left over, not cached
+    assert session.prefix_stats(prompt) == (3, len(tokens) - 3)
+
+def test_prompt_tokens_match_full_tokenization_across_turns():
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = []
+    for user_input in ("hello there", "tell me about cats", "and bubble tea?"):
+        prompt = session.build_prompt("", chat_history, user_input, memories=["User: hi\nAssistant: hello"])
+        assert session.prompt_tokens(prompt) == llm.tokenize(prompt.encode("utf-8"), special=True)
+        chat_turn(llm, session, chat_history, user_input)
+
+def test_history_token_count_matches_rendered_turns():
+    from utils import ChatHistory, count_tokens
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = ChatHistory(llm, user_overhead=session.turn_overhead())
+    for user_input in ("hello there", "tell me about cats"):
+        chat_turn(llm, session, chat_history, user_input)
+    rendered = session.render_history("", chat_history)
+    assert session.turn_overhead() > 0
+    assert abs(chat_history.total_tokens - count_tokens(llm, rendered)) <= 2
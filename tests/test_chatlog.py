@@ -0,0 +1,31 @@
+import gzip
+import json
+from chatlog import ConversationLogReader
+
+def write_log(tmp_path, n_entries: int = 40):
+    """Two rotated segments (one gzipped) plus the live log, with "tea" in every third entry."""
+    log_path = tmp_path / "conversation.json"
+    entries = [{"timestamp": f"2025-01-01T00:00:{i:02d}Z", "user": f"question {i}" + (" about tea" if i % 3 == 0 else ""), "assistant": f"answer {i}"} for i in range(n_entries)]
+    lines = [json.dumps(entry) + "\n" for entry in entries]
+    with gzip.open(tmp_path / "conversation.20250101-000000-000000.json.gz", "wt") as f:
+        f.writelines(lines[:15])
+    (tmp_path / "conversation.20250101-000010-000000.json").write_text("".join(lines[15:30]))
+    log_path.write_text("".join(lines[30:]))
+    return str(log_path), entries
+
+def test_entries_at_across_segments(tmp_path):
+    log_path, entries = write_log(tmp_path)
+    reader = ConversationLogReader(log_path)
+    assert reader.build_index() == len(entries)
+    positions = [33, 2, 17, 14, 0, 39]
+    assert reader.entries_at(positions) == [entries[p] for p in positions]
+    assert reader.entry(12) == entries[12]
+
+def test_sample_applies_filters(tmp_path):
+    log_path, entries = write_log(tmp_path)
+    reader = ConversationLogReader(log_path)
+    sample = reader.sample(5, seed=1, since="2025-01-01T00:00:10Z", contains="TEA")
+    expected = [e for e in entries if e["timestamp"] >= "2025-01-01T00:00:10Z" and "tea" in e["user"]]
+    assert len(sample) == 5 and all(entry in expected for entry in sample)
+    assert sorted(e["timestamp"] for e in reader.sample(100, seed=1, contains="tea")) == [e["timestamp"] for e in entries if "tea" in e["user"]]
+    assert len(reader.sample(5, seed=1)) == 5
@@ -0,0 +1,66 @@
+from conftest import MirrorLlama
+from memory import VectorMemory, HashingEmbedder
+
+def test_recall_persists_and_skips_turns_in_history(tmp_path):
+    memory = VectorMemory(HashingEmbedder(128), str(tmp_path))
+    memory.add("User: my cat is called Biscuit\nAssistant: cute!", messages=["User: my cat is called Biscuit", "Assistant: cute!"])
+    memory.add("User: I like bubble tea\nAssistant: yum", messages=["User: I like bubble tea", "Assistant: yum"])
+    memory.close()
+
+    memory = VectorMemory(HashingEmbedder(128), str(tmp_path))
+    assert memory.count == 2
+    llm = MirrorLlama()
+    assert memory.recall(llm, "what is my cat called?", 100, top_k=1) == ["User: my cat is called Biscuit\nAssistant: cute!"]
+    in_history = {"User: my cat is called Biscuit", "Assistant: cute!"}
+    recalled = memory.recall(llm, "what is my cat called?", 100, top_k=1, skip=lambda record: all(m in in_history for m in record["messages"]))
+    assert recalled == ["User: I like bubble tea\nAssistant: yum"]         # the skipped turn does not use up the only slot
+    memory.close()
+
+def test_embedder_change_reembeds(tmp_path):
+    memory = VectorMemory(HashingEmbedder(128), str(tmp_path))
+    memory.add("User: hello\nAssistant: hi")
+    memory.close()
+    memory = VectorMemory(HashingEmbedder(64), str(tmp_path))
+    assert memory.count == 1 and memory.matrix.shape[1] == 64
+    memory.close()
+
+def test_turns_in_history_do_not_crowd_out_recall(tmp_path):
+    memory = VectorMemory(HashingEmbedder(128), str(tmp_path))
+    rex = "User: my dog is named Rex\nAssistant: Rex is a great name"
+    memory.add(rex, messages=rex.split("\n"))
+    in_history = set()
+    for i in range(10):
+        turn = [f"User: what is the name of my dog's favourite toy number {i}?", f"Assistant: the name of your dog's toy {i} is Ball"]
+        memory.add("\n".join(turn), messages=turn)
+        in_history.update(turn)
+    memory.close()
+
+    memory = VectorMemory(HashingEmbedder(128), str(tmp_path))
+    llm = MirrorLlama()
+    query = "what is the name of my dog?"
+    ranked = [memory.record(index)["text"] for _, index in memory.search(query, top_k=11)]
+    assert ranked.index(rex) >= 8
+    recalled = memory.recall(llm, query, 1000, top_k=8, skip=lambda record: all(m in in_history for m in record["messages"]))
+    assert recalled == [rex]
+    memory.close()
+
+def test_offsets_file_is_used_and_repaired(tmp_path):
+    memory = VectorMemory(HashingEmbedder(64), str(tmp_path))
+    for text in ("User: one", "User: two", "User: three"):
+        memory.add(text)
+    memory.close()
+    offsets_path = tmp_path / "offsets.u64"
+    assert offsets_path.stat().st_size == 3 * 8
+
+    with open(tmp_path / "texts.jsonl", "ab") as f:          # a record whose offset and vector were never written
+        f.write(b'{"text": "User: torn"}\n')
+    memory = VectorMemory(HashingEmbedder(64), str(tmp_path))
+    assert memory.count == 3 and memory.record(2)["text"] == "User: three"
+    memory.add("User: four")
+    memory.close()
+
+    offsets_path.unlink()
+    memory = VectorMemory(HashingEmbedder(64), str(tmp_path))
+    assert memory.count == 4 and memory.record(3)["text"] == "User: four"
+    assert offsets_path.stat().st_size == 4 * 8
+    memory.close()
@@ -0,0 +1,117 @@
+import json
+import time
+import socket
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from benchmark import FakeLlama
+from server import ComfyServer
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    port = free_port()
+    config = {
+        "model_path": "models/fake.gguf",
+        "n_ctx": 2048,
+        "max_tokens": 8,
+        "temperature": 0.9, "top_p": 0.95, "top_k": 40, "frequency_penalty": 0.5, "presence_penalty": 0.5, "repeat_penalty": 1.0,
+        "stop": ["</s>", "User:"],
+        "system_prompt": "You are a helpful AI chatbot.",
+        "prompt_template": "{system_prompt}\n### Context:\n{chat_history}\n### Instruction:\nUser: {user_input}\n### Response:\nAssistant:",
+        "logging": {"log_json": str(tmp_path_factory.mktemp("logs") / "conversation.json")},
+        "server": {"host": "127.0.0.1", "port": port, "max_queue": 1, "max_session_queue": 1, "max_sessions": 2},
+    }
+    server = ComfyServer(FakeLlama(n_ctx=2048, gen_ms_per_token=20), config)
+    threading.Thread(target=asyncio.run, args=(server.run(),), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    server.base_url = f"http://127.0.0.1:{port}"
+    return server
+
+@pytest.fixture
+def base_url(server):
+    return server.base_url
+
+def request(base_url: str, path: str, body: dict = None, method: str = "POST"):
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    return urllib.request.urlopen(urllib.request.Request(base_url + path, data=data, method=method, headers={"Content-Type": "application/json"}), timeout=10)
+
+def post_json(base_url: str, path: str, body: dict) -> tuple:
+    try:
+        with request(base_url, path, body) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def sse_events(response) -> list:
+    return [json.loads(line[6:]) for line in response.read().decode("utf-8").splitlines() if line.startswith("data: {")]
+
+def test_plain_completion(base_url):
+    status, body = post_json(base_url, "/v1/completions", {"prompt": "Once upon a time", "max_tokens": 4})
+    assert status == 200 and body["choices"][0]["text"].strip()
+    assert body["usage"]["completion_tokens"] == 4
+
+def test_chat_completion_stream(base_url):
+    with request(base_url, "/v1/chat/completions", {"messages": [{"role": "user", "content": "hello"}], "stream": True, "max_tokens": 4, "session_id": "sse"}) as response:
+        assert response.headers["Content-Type"] == "text/event-stream"
+        events = sse_events(response)
+    assert "".join(e["choices"][0]["delta"].get("content", "") for e in events).strip()
+    assert events[-1]["choices"][0]["finish_reason"] is not None
+
+@pytest.mark.parametrize("body", [
+    {"prompt": "x", "max_tokens": "lots"},
+    {"prompt": "x", "max_tokens": 0},
+    {"prompt": "x", "temperature": "hot"},
+    {"prompt": "x", "top_p": 2},
+    {"prompt": "x", "stop": [1, 2]},
+    {"prompt": 3},
+])
+def test_invalid_parameters_are_rejected(base_url, body):
+    status, response = post_json(base_url, "/v1/completions", body)
+    assert status == 400 and response["error"]["type"] == "invalid_request_error"
+
+def test_queue_limit_and_cancel(base_url):
+    running = request(base_url, "/v1/completions", {"prompt": "a", "max_tokens": 50, "stream": True})
+    time.sleep(0.2)
+    queued = request(base_url, "/v1/completions", {"prompt": "b", "max_tokens": 50, "stream": True})
+    status, body = post_json(base_url, "/v1/completions", {"prompt": "c", "max_tokens": 4})
+    assert status == 429 and body["error"]["type"] == "rate_limit_error"
+
+    with request(base_url, f"/v1/requests/{queued.headers['X-Request-Id']}", method="DELETE") as response:
+        assert response.status == 200
+    assert sse_events(queued)[-1]["choices"][0]["finish_reason"] == "cancelled"
+    with request(base_url, f"/v1/requests/{running.headers['X-Request-Id']}", method="DELETE") as response:
+        assert response.status == 200
+    assert sse_events(running)[-1]["choices"][0]["finish_reason"] == "cancelled"
+    queued.close()
+    running.close()
+
+def test_chat_without_session_is_stateless(server, base_url):
+    messages = [{"role": "system", "content": "You are a pirate."}, {"role": "user", "content": "my name is Ann"}, {"role": "assistant", "content": "Ahoy Ann"}, {"role": "user", "content": "what is my name?"}]
+    status, body = post_json(base_url, "/v1/chat/completions", {"messages": messages, "max_tokens": 2})
+    assert status == 200 and body["choices"][0]["message"]["content"]
+    assert all("User: what is my name?" not in session.chat_history for session in server.sessions.values())
+
+    _, prompt = server.stateless_prompt(messages)
+    assert prompt.startswith("You are a pirate.") and "User: my name is Ann" in prompt and " Ahoy Ann" in prompt
+    assert prompt.endswith("User: what is my name?\n### Response:\nAssistant:")
+
+def test_sessions_are_created_on_accept_and_capped(server, base_url):
+    status, _ = post_json(base_url, "/v1/chat/completions", {"messages": [{"role": "user", "content": "hi"}], "max_tokens": "lots", "session_id": "rejected"})
+    assert status == 400 and "rejected" not in server.sessions
+    for session_id in ("a", "b", "c"):
+        status, _ = post_json(base_url, "/v1/chat/completions", {"messages": [{"role": "user", "content": f"hi from {session_id}"}], "max_tokens": 2, "session_id": session_id})
+        assert status == 200
+    assert list(server.sessions) == ["b", "c"]
+    assert server.sessions["c"].chat_history[0] == "User: hi from c" and len(server.sessions["c"].chat_history) == 2
@@ -0,0 +1,77 @@
+import pytest
+from conftest import MirrorLlama
+from session import ChatSession, SessionStore
+
+CONFIG = {
+    "model_path": "models/test.gguf",
+    "n_ctx": 256,
+    "prompt_template": "{system_prompt}\n### Context:\n{chat_history}\n### Instruction:\nUser: {user_input}\n### Response:\nAssistant:",
+    "system_prompt": "You are a helpful AI chatbot.",
+}
+
+def chat_turn(llm, session, chat_history, user_input):
+    prompt = session.build_prompt("", chat_history, user_input)
+    answer_tokens = llm.generate(llm.tokenize(prompt.encode("utf-8"), special=True))
+    answer = " ".join(f"w{token}" for token in answer_tokens)
+    chat_history.extend([f"User: {user_input}", f"Assistant: {answer}"])
+    return prompt
+
+@pytest.mark.parametrize("logits_all", [False, True])
+def test_save_load_generate_round_trip(tmp_path, logits_all):
+    llm = MirrorLlama(logits_all=logits_all)
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = []
+    for user_input in ("my cat is called Biscuit", "she likes bubble tea", "tell me a story about her"):
+        chat_turn(llm, session, chat_history, user_input)
+    assert llm.n_tokens > llm.n_batch
+
+    store = SessionStore(llm, CONFIG, sessions_dir=str(tmp_path))
+    meta = store.save("cats", chat_history, "")
+    assert meta["kv"]["n_tokens"] == llm.n_tokens
+
+    resumed = MirrorLlama(logits_all=logits_all)
+    messages, summary, restored = SessionStore(resumed, CONFIG, sessions_dir=str(tmp_path)).load("cats")
+    assert restored and messages == chat_history
+    assert list(resumed._input_ids) == list(llm._input_ids)
+    assert len(resumed.input_ids) == resumed.n_ctx()
+
+    # Only the new turn is evaluated after a restore, and generation keeps working across turns
+    resumed_session = ChatSession(resumed, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    prompt = resumed_session.build_prompt("", messages, "what is her name?")
+    reused, evaluated = resumed_session.prefix_stats(prompt)
+    chat_turn(resumed, resumed_session, messages, "what is her name?")
+    chat_turn(resumed, resumed_session, messages, "and what does she like?")
+    assert reused > 0 and evaluated < len(resumed.tokenize(prompt.encode("utf-8"))) // 2
+
+def test_snapshot_not_restored_for_other_model(tmp_path):
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = []
+    chat_turn(llm, session, chat_history, "hello")
+    SessionStore(llm, CONFIG, sessions_dir=str(tmp_path)).save("hello", chat_history, "")
+
+    other = MirrorLlama()
+    messages, _, restored = SessionStore(other, dict(CONFIG, model_path="models/other.gguf"), sessions_dir=str(tmp_path)).load("hello")
+    assert messages == chat_history and not restored and other.n_tokens == 0
+
+def test_eviction_keeps_history(tmp_path):
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = []
+    chat_turn(llm, session, chat_history, "hello there")
+    store = SessionStore(llm, CONFIG, sessions_dir=str(tmp_path), max_bytes=1)
+    store.save("old", chat_history, "")
+    store.save("new", chat_history, "")
+    sessions = {s["name"]: s for s in store.list_sessions()}
+    assert sessions["old"]["kv_tokens"] == 0 and sessions["old"]["messages"] == 2
+    assert sessions["new"]["kv_tokens"] > 0
+
+def test_delete_removes_session(tmp_path):
+    llm = MirrorLlama()
+    session = ChatSession(llm, CONFIG["prompt_template"], CONFIG["system_prompt"])
+    chat_history = []
+    chat_turn(llm, session, chat_history, "hello")
+    store = SessionStore(llm, CONFIG, sessions_dir=str(tmp_path))
+    store.save("gone", chat_history, "")
+    assert store.delete("gone") and not store.exists("gone") and not (tmp_path / "gone").exists()
+    assert not store.delete("gone")
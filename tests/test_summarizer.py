@@ -0,0 +1,74 @@
+import threading
+import pytest
+import utils
+from conftest import MirrorLlama
+from utils import BackgroundSummarizer, ChatHistory
+
+class GatedSummarizer:
+    """Replaces run_summarizer: each call waits until released, so tests decide when a summary "finishes"."""
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def __call__(self, summary: str, messages: list) -> str:
+        self.calls.append(list(messages))
+        self.started.set()
+        self.release.wait(5)
+        return f"summary of {len(messages)} messages"
+
+@pytest.fixture
+def gated(monkeypatch):
+    gated = GatedSummarizer()
+    monkeypatch.setattr(utils, "run_summarizer", gated)
+    return gated
+
+def history(llm, n_turns: int) -> ChatHistory:
+    chat_history = ChatHistory(llm)
+    for i in range(n_turns):
+        chat_history.extend([f"User: tell me about topic number {i}", f"Assistant: here is something about topic {i}"])
+    return chat_history
+
+def test_finished_summary_is_applied_next_turn(gated):
+    llm = MirrorLlama()
+    summarizer = BackgroundSummarizer(token_budget=1000, token_threshold=20, keep_turns=1)
+    chat_history = history(llm, 3)
+    summarizer.submit(chat_history, "")
+    gated.release.set()
+    summarizer.idle.wait(5)
+
+    summary, chat_tokens, summary_tokens, total_tokens = summarizer.prepare_turn(llm, chat_history, "", "next question")
+    assert summary == "summary of 4 messages" and len(gated.calls[0]) == 4
+    assert chat_history == ["User: tell me about topic number 2", "Assistant: here is something about topic 2"]
+    assert chat_tokens == chat_history.total_tokens and total_tokens == chat_tokens + summary_tokens
+
+def test_late_result_after_reset_is_discarded(gated):
+    llm = MirrorLlama()
+    summarizer = BackgroundSummarizer(token_budget=1000, token_threshold=20, keep_turns=1)
+    chat_history = history(llm, 3)
+    summarizer.submit(chat_history, "")
+    assert gated.started.wait(5)
+
+    summarizer.reset()                                          # /restart while the summary is still running
+    chat_history.clear()
+    chat_history.extend(["User: a new conversation", "Assistant: hello again"])
+    gated.release.set()
+    summarizer.idle.wait(5)
+
+    summary, _, _, _ = summarizer.prepare_turn(llm, chat_history, "This is the start of a new conversation.", "hi")
+    assert summary == "This is the start of a new conversation."
+    assert chat_history == ["User: a new conversation", "Assistant: hello again"]
+
+def test_overflowing_turn_waits_for_the_running_summary(gated):
+    llm = MirrorLlama()
+    chat_history = history(llm, 4)
+    summarizer = BackgroundSummarizer(token_budget=chat_history.total_tokens + 5, token_threshold=20, keep_turns=1)
+    summarizer.submit(chat_history, "")
+    assert gated.started.wait(5)
+
+    chat_history.extend(["User: one more long question about many other things", "Assistant: and a long answer to it"])
+    threading.Timer(0.1, gated.release.set).start()
+    summary, _, _, total_tokens = summarizer.prepare_turn(llm, chat_history, "", "and another question")
+    assert summary == "summary of 6 messages" and len(gated.calls) == 1
+    assert chat_history[0] == "User: tell me about topic number 3" and len(chat_history) == 4
+    assert total_tokens <= summarizer.token_budget
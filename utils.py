@@ -2,10 +2,10 @@ import sys
 import os
 import time
 import json
+import platform
 import logging
+import queue
 import threading
-from llama_cpp import Llama
-from datetime import datetime
 from contextlib import contextmanager
 
 # ==========================================================
@@ -62,6 +62,58 @@ def load_config(config_path="config.json"):
         logging.error(f"Unexpected error loading config: {e}")
         raise
 
+HARDWARE_PROFILE_KEYS = ("n_gpu_layers", "n_threads", "n_threads_batch", "n_batch", "n_ubatch", "flash_attn", "use_mmap")
+
+def load_hardware_profiles(profiles_path="hardware_profiles.json") -> dict:
+    if not os.path.exists(profiles_path):
+        return {}
+    with open(profiles_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_hardware_profiles(profiles: dict, profiles_path="hardware_profiles.json"):
+    tmp_path = profiles_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, profiles_path)
+
+def hardware_profile_name(config: dict, name: str = None) -> str:
+    """Explicit name, else config's hardware_profile, else this machine's hostname."""
+    return name or config.get("hardware_profile") or platform.node() or "default"
+
+def apply_hardware_profile(config: dict, name: str = None) -> str:
+    """
+    Overrides the thread/batch/offload settings in config with a profile written by --autotune.
+    Returns the applied profile name, or None if there is no matching profile.
+    """
+    profile_name = hardware_profile_name(config, name)
+    profile = load_hardware_profiles(config.get("hardware_profiles_path", "hardware_profiles.json")).get(profile_name)
+    if profile is None:
+        if name:
+            logging.warning(f"Hardware profile {profile_name} not found, using config.json settings.")
+        return None
+    if profile.get("model_path") not in (None, config["model_path"]):
+        logging.warning(f"Hardware profile {profile_name} was tuned for {profile['model_path']}, not {config['model_path']}.")
+    config.update({key: profile[key] for key in HARDWARE_PROFILE_KEYS if key in profile})
+    logging.debug("Applied hardware profile %s: %s", profile_name, {key: config[key] for key in HARDWARE_PROFILE_KEYS})
+    return profile_name
+
+def model_params(config: dict) -> dict:
+    """
+    Collects the Llama constructor arguments for the main model from config.
+    """
+    return {
+        "model_path": config["model_path"],
+        "n_ctx": config["n_ctx"],
+        "n_gpu_layers": config["n_gpu_layers"],
+        "n_batch": config["n_batch"],
+        "n_ubatch": config["n_ubatch"],
+        "n_threads": config["n_threads"],
+        "n_threads_batch": config["n_threads_batch"],
+        "flash_attn": config["flash_attn"],
+        "use_mmap": config.get("use_mmap", True),
+        "use_mlock": config.get("use_mlock", False),
+    }
+
 def setup_loggers(debug_mode, log_file_path):
     class ColorFormatter(logging.Formatter):
         LEVEL_COLORS = {
@@ -115,8 +167,8 @@ def is_command(input_str, commands):
     input_str = input_str.strip()
     if not input_str.startswith('/'):
         return False
-    cmd = input_str[1:]
-    return cmd.lower() in [c.lower() for c in commands]
+    cmd = input_str[1:].split(maxsplit=1)
+    return bool(cmd) and cmd[0].lower() in [c.lower() for c in commands]
 
 def loading_animation():
     sys.stdout.write("\033[?25l")
@@ -126,12 +178,53 @@ def loading_animation():
         dots = "." * (i % 4)
         sys.stdout.write(f"\r\033[90mComfyAI is thinking{dots}{' ' * (3 - len(dots))}")
         sys.stdout.flush()
-        time.sleep(0.5)
+        for _ in range(10):                                     # short sleeps so a streamed first token is not held back
+            if not loading_flag.is_set():
+                break
+            time.sleep(0.05)
         i += 1
     sys.stdout.write("\r" + " " * 50 + "\r")
     sys.stdout.write("\033[?25h")
     sys.stdout.flush()
 
+def start_loading_animation():
+    loading_flag.set()
+    anim_thread = threading.Thread(target=loading_animation)
+    anim_thread.start()
+    return anim_thread
+
+def stop_loading_animation(anim_thread):
+    if anim_thread is None:
+        return
+    loading_flag.clear()
+    anim_thread.join()
+
+class StartupProfile:
+    """
+    Records how long each startup phase takes, measured from start_time (usually process start).
+    """
+    def __init__(self, start_time: float = None):
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - phase_start))
+
+    def add(self, name: str, seconds: float):
+        self.phases.append((name, seconds))
+
+    def report(self) -> str:
+        lines = ["Startup profile:"]
+        for name, seconds in self.phases:
+            lines.append(f"  {name:<30} {seconds * 1000:>9.1f} ms")
+        lines.append(f"  {'time to first prompt':<30} {(time.perf_counter() - self.start_time) * 1000:>9.1f} ms")
+        return "\n".join(lines)
+
 # ==========================================================
 #                      PROMPT HELPERS
 # ==========================================================
@@ -144,41 +237,216 @@ def format_prompt(prompt_template: str, system_prompt: str, chat_history: str, u
 def concat_chat_history(chat_history: list) -> str:
     return "\n".join(chat_history)
 
+def format_memories(memories: list) -> str:
+    """
+    Renders recalled memories as a block that goes after the chat history, right before the current turn.
+    """
+    if not memories:
+        return ""
+    return "\n### Relevant memories:\n" + "\n".join(memories)
+
+# ==========================================================
+#                   GENERATION HELPERS
+# ==========================================================
+SAMPLING_KEYS = ("temperature", "top_p", "top_k", "frequency_penalty", "presence_penalty", "repeat_penalty", "stop")
+
+def sampling_params(config: dict) -> dict:
+    """
+    Collects the sampling settings from config as keyword arguments for a Llama call.
+    """
+    return {key: config[key] for key in SAMPLING_KEYS}
+
+def generate_response(llama_cpp, prompt: str, config: dict, max_tokens: int, stream: bool = False, anim_thread=None) -> tuple:
+    """
+    Runs a completion, prints the answer and returns it with timing stats for the turn.
+    In stream mode tokens are printed as they are produced and the loading animation stops on the first token.
+    """
+    params = sampling_params(config)
+    start_time = time.perf_counter()
+    first_token_time = None
+
+    if stream:
+        pieces = []
+        n_tokens = 0
+        for chunk in llama_cpp(prompt=prompt, max_tokens=max_tokens, stream=True, **params):
+            text = chunk.get('choices', [{}])[0].get('text', '')
+            n_tokens += 1
+            if first_token_time is None:
+                text = text.lstrip()
+                if not text:
+                    continue
+                first_token_time = time.perf_counter()
+                stop_loading_animation(anim_thread)
+                sys.stdout.write(f"{color_assistant}ComfyAI: ")
+            pieces.append(text)
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+        if first_token_time is None:
+            stop_loading_animation(anim_thread)
+            sys.stdout.write(f"{color_assistant}ComfyAI: ")
+        sys.stdout.write(f"{color_reset}\n\n")
+        sys.stdout.flush()
+        answer = "".join(pieces).strip()
+    else:
+        response = llama_cpp(prompt=prompt, max_tokens=max_tokens, **params)
+        stop_loading_animation(anim_thread)
+        answer = response.get('choices', [{}])[0].get('text', '').strip()
+        n_tokens = response.get('usage', {}).get('completion_tokens', 0)
+        print_assistant(f"ComfyAI: {answer}\n")
+
+    end_time = time.perf_counter()
+    if first_token_time is None:
+        first_token_time = end_time
+    ttft = first_token_time - start_time
+    decode_time = end_time - first_token_time if stream else end_time - start_time
+    tokens_per_sec = n_tokens / decode_time if decode_time > 0 else 0.0
+
+    stats = {"ttft": ttft, "elapsed": end_time - start_time, "completion_tokens": n_tokens, "tokens_per_sec": tokens_per_sec}
+    logging.info(f"Generation -> TTFT: {ttft:.2f}s. Tokens: {n_tokens}. Speed: {tokens_per_sec:.2f} tokens/s. Total: {stats['elapsed']:.2f}s\n")
+    return answer, stats
+
+# ==========================================================
+#                    TOKEN ACCOUNTING
+# ==========================================================
+SUMMARY_MAX_TOKENS = 512                                        # max_tokens for the summarizer reply
+
+def count_tokens(llama_cpp, text: str) -> int:
+    return len(llama_cpp.tokenize(text.encode("utf-8"), add_bos=False))
+
+class ChatHistory(list):
+    """
+    List of chat messages that tokenizes each message once when it is appended and keeps a running total.
+    The newline joining two messages is counted as one token, and every "User: " message also counts
+    user_overhead tokens for the turn template it is rendered through (see ChatSession.turn_overhead).
+    """
+    def __init__(self, llama_cpp, messages=(), user_overhead: int = 0):
+        super().__init__()
+        self.llama_cpp = llama_cpp
+        self.user_overhead = user_overhead
+        self.occurrences = {}                                   # message -> count, for O(1) membership tests
+        self.token_counts = []
+        self.total_tokens = 0
+        self._summary = None
+        self._summary_tokens = 0
+        self.extend(messages)
+
+    def append(self, message):
+        n_tokens = count_tokens(self.llama_cpp, message) + (1 if self else 0)
+        if message.startswith("User: "):
+            n_tokens += self.user_overhead
+        super().append(message)
+        self.occurrences[message] = self.occurrences.get(message, 0) + 1
+        self.token_counts.append(n_tokens)
+        self.total_tokens += n_tokens
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __contains__(self, message) -> bool:
+        return message in self.occurrences
+
+    def clear(self):
+        super().clear()
+        self.occurrences.clear()
+        self.token_counts.clear()
+        self.total_tokens = 0
+
+    def drop_oldest(self, n_messages: int):
+        """
+        Removes the n oldest messages, e.g. once they have been folded into the summary.
+        """
+        if n_messages <= 0:
+            return
+        for message in self[:n_messages]:
+            self.occurrences[message] -= 1
+            if not self.occurrences[message]:
+                del self.occurrences[message]
+        super().__delitem__(slice(0, n_messages))
+        self.total_tokens -= sum(self.token_counts[:n_messages])
+        del self.token_counts[:n_messages]
+        if self.token_counts:
+            self.token_counts[0] -= 1                           # new first message no longer follows a newline
+            self.total_tokens -= 1
+
+    def summary_tokens(self, summary: str) -> int:
+        """
+        Token count of the summary, only re-tokenized when the summary text changes.
+        """
+        if summary != self._summary:
+            self._summary = summary
+            self._summary_tokens = count_tokens(self.llama_cpp, summary)
+        return self._summary_tokens
+
+def history_token_budget(llama_cpp, config: dict, reserved: int = 0) -> int:
+    """
+    Tokens left for summary and chat history once the prompt template, system prompt, reply and any
+    reserved tokens (e.g. recalled memories) are accounted for.
+    """
+    overhead = count_tokens(llama_cpp, format_prompt(config["prompt_template"], config["system_prompt"], "", "")) + 1
+    return max(config["n_ctx"] - config["max_tokens"] - overhead - reserved, 0)
+
+def summary_token_threshold(token_budget: int) -> int:
+    """
+    History size that triggers summarization, leaving room in the budget for the summary itself.
+    """
+    return max(token_budget - SUMMARY_MAX_TOKENS, token_budget // 2)
+
 # ==========================================================
 #                 SUMMARIZATION HELPERS
 # ==========================================================
-config = load_config("config.json")
+summarizer_config = None
 summarizer_llm = None
+summarizer_verbose = False
+summarizer_lock = threading.Lock()
+
+def configure_summarizer(config: dict, verbose: bool = False):
+    """
+    Hand the already loaded config to the summarizer so it does not read config.json again.
+    llama.cpp's load and timing output is only printed when verbose is set (debug mode): the summarizer loads and
+    runs on background threads while the user is typing, where it would print over the input line.
+    """
+    global summarizer_config, summarizer_verbose
+    summarizer_config = config
+    summarizer_verbose = verbose
 
 def get_summarizer():
     """Load the summarizer only when first needed."""
-    global summarizer_llm
-    if summarizer_llm is None:
-        logging.debug("Loading summarizer model...")
-        summarizer_llm = Llama(model_path=config["summarizer_path"], n_ctx=config["n_ctx"])
+    global summarizer_llm, summarizer_config
+    with summarizer_lock:
+        if summarizer_llm is None:
+            if summarizer_config is None:
+                summarizer_config = load_config()
+            from llama_cpp import Llama                         # imported here so utils loads without llama_cpp
+            logging.debug("Loading summarizer model...")
+            summarizer_llm = Llama(model_path=summarizer_config["summarizer_path"], n_ctx=summarizer_config["n_ctx"], use_mmap=summarizer_config.get("use_mmap", True), use_mlock=summarizer_config.get("use_mlock", False), verbose=summarizer_verbose)
     return summarizer_llm
 
-def summarize_chat_history(llama_cpp, chat_history: list, summary: str, token_threshold: int = 512) -> str:
+def preload_summarizer(profile=None):
+    """Load the summarizer on a background thread, e.g. while the main model is loading."""
+    def load():
+        try:
+            if profile is None:
+                get_summarizer()
+            else:
+                with profile.phase("summarizer load (parallel)"):
+                    get_summarizer()
+        except Exception:
+            logging.exception("Failed to preload summarizer model")
+
+    preload_thread = threading.Thread(target=load, daemon=True)
+    preload_thread.start()
+    return preload_thread
+
+def run_summarizer(summary: str, messages: list) -> str:
+    """
+    Folds messages into the running summary with the summarizer model and returns the new summary.
+    """
     summarizer_llm = get_summarizer()
-    
-    if not summary:
-        summary = "This is the start of a new conversation."
-
-    if not chat_history:
-        chat_tokens = 0
-        summary_tokens = len(llama_cpp.tokenize(summary.encode("utf-8")))
-        total_tokens = chat_tokens + summary_tokens
-        return summary, chat_tokens, summary_tokens, total_tokens
-
-    chat_text = "\n".join(chat_history)
-    chat_tokens = len(llama_cpp.tokenize(chat_text.encode("utf-8")))
-    
-    if chat_tokens < token_threshold:
-        summary_tokens = len(llama_cpp.tokenize(summary.encode("utf-8")))
-        total_tokens = chat_tokens + summary_tokens
-        return summary, chat_tokens, summary_tokens, total_tokens
 
     # Build summarization prompt
+    chat_text = concat_chat_history(messages)
     summarizer_prompt = f"<|user|>\nSummarize the following conversation between a user and an assistant into a concise paragraph, keeping important key facts and context:\n{summary}\n{chat_text}<|end|>\n<|assistant|>"
 
     # Log the prompt before sending to model
@@ -187,7 +455,7 @@ def summarize_chat_history(llama_cpp, chat_history: list, summary: str, token_th
     # Use default config values if none provided
     response = summarizer_llm(
     prompt=summarizer_prompt,
-    max_tokens=512,
+    max_tokens=SUMMARY_MAX_TOKENS,
     stop=["</s>", "User:"]
     )
 
@@ -196,29 +464,146 @@ def summarize_chat_history(llama_cpp, chat_history: list, summary: str, token_th
 
     # Extract summarized text
     new_summary = response.get("choices", [{}])[0].get("text", "").strip()
-    summary = new_summary if new_summary else summary
+    return new_summary if new_summary else summary
+
+def messages_to_compress(chat_history: list, keep_messages: int) -> int:
+    """
+    Number of oldest messages to fold into the summary, keeping the most recent ones verbatim when possible.
+    """
+    n_messages = len(chat_history) - keep_messages
+    if n_messages <= 0:
+        n_messages = len(chat_history) - 2
+    if n_messages <= 0:
+        n_messages = len(chat_history)
+    return n_messages
+
+def summarize_chat_history(llama_cpp, chat_history: ChatHistory, summary: str, token_threshold: int = 512, keep_messages: int = 0) -> str:
+    if not summary:
+        summary = "This is the start of a new conversation."
 
-    # Clear chat history after summarization
-    chat_history.clear()
+    # Running totals kept by ChatHistory, nothing is re-tokenized here
+    chat_tokens = chat_history.total_tokens
+    summary_tokens = chat_history.summary_tokens(summary)
+    total_tokens = chat_tokens + summary_tokens
+
+    if not chat_history or total_tokens < token_threshold:
+        return summary, chat_tokens, summary_tokens, total_tokens
+
+    # Fold the oldest messages into the summary and drop them from the history
+    n_messages = messages_to_compress(chat_history, keep_messages)
+    summary = run_summarizer(summary, chat_history[:n_messages])
+    chat_history.drop_oldest(n_messages)
 
     # Token counts for logging
-    summary_tokens = len(llama_cpp.tokenize(summary.encode("utf-8")))
+    summary_tokens = chat_history.summary_tokens(summary)
     total_tokens = chat_tokens + summary_tokens
 
     return summary, chat_tokens, summary_tokens, total_tokens
 
+class BackgroundSummarizer:
+    """
+    Summarizes the oldest turns on a worker thread after a reply is delivered, keeping the last keep_turns turns verbatim.
+    Finished summaries are swapped in at the start of the next turn; a turn only waits on the worker when its prompt
+    would otherwise overflow the context budget.
+    """
+    def __init__(self, token_budget: int, token_threshold: int, keep_turns: int = 4, background: bool = True):
+        self.token_budget = token_budget
+        self.token_threshold = token_threshold
+        self.keep_messages = keep_turns * 2
+        self.background = background
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.result = None
+        self.busy = False
+        self.epoch = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        if background:
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            epoch, summary, messages = self.jobs.get()
+            start_time = time.perf_counter()
+            try:
+                new_summary = run_summarizer(summary, messages)
+            except Exception:
+                logging.exception("Background summarization failed")
+                new_summary = None
+            elapsed = time.perf_counter() - start_time
+            logging.debug("Summarizer -> Compressed %d messages in %.2fs. Queue depth: %d", len(messages), elapsed, self.jobs.qsize())
+            with self.lock:
+                if new_summary is not None and epoch == self.epoch:
+                    self.result = (new_summary, len(messages))
+                self.busy = False
+                self.idle.set()
+
+    def submit(self, chat_history: ChatHistory, summary: str):
+        """
+        Queues the oldest turns for summarization if the history has crossed the threshold. Call after a reply.
+        """
+        if not self.background or not chat_history:
+            return
+        if chat_history.total_tokens + chat_history.summary_tokens(summary) < self.token_threshold:
+            return
+        with self.lock:
+            if self.busy or self.result is not None:
+                return
+            self.busy = True
+            self.idle.clear()
+            n_messages = messages_to_compress(chat_history, self.keep_messages)
+            self.jobs.put((self.epoch, summary, list(chat_history[:n_messages])))
+        logging.debug("Summarizer -> Queued %d messages. Queue depth: %d", n_messages, self.jobs.qsize())
+
+    def apply(self, chat_history: ChatHistory, summary: str) -> str:
+        """
+        Swaps in a finished summary and drops the messages it covers. Returns the current summary.
+        """
+        with self.lock:
+            result, self.result = self.result, None
+        if result is None:
+            return summary
+        new_summary, n_messages = result
+        chat_history.drop_oldest(n_messages)
+        return new_summary
+
+    def reset(self):
+        """
+        Discards pending and in-flight results, e.g. after /restart.
+        """
+        with self.lock:
+            self.epoch += 1
+            self.result = None
+
+    def prepare_turn(self, llama_cpp, chat_history: ChatHistory, summary: str, user_input: str) -> tuple:
+        """
+        Brings summary and history up to date before a turn. Only blocks on the summarizer when the prompt would not fit.
+        Returns the same (summary, chat_tokens, summary_tokens, total_tokens) tuple as summarize_chat_history.
+        """
+        if not self.background:
+            return summarize_chat_history(llama_cpp, chat_history, summary, self.token_threshold, self.keep_messages)
+
+        if not summary:
+            summary = "This is the start of a new conversation."
+        summary = self.apply(chat_history, summary)
+
+        reserve = count_tokens(llama_cpp, user_input)
+        if chat_history.total_tokens + chat_history.summary_tokens(summary) + reserve > self.token_budget:
+            if not self.idle.is_set():
+                wait_start = time.perf_counter()
+                self.idle.wait()
+                logging.debug("Summarizer -> Turn blocked %.2fs waiting for summary", time.perf_counter() - wait_start)
+                summary = self.apply(chat_history, summary)
+            if chat_history.total_tokens + chat_history.summary_tokens(summary) + reserve > self.token_budget:
+                return summarize_chat_history(llama_cpp, chat_history, summary, 0, self.keep_messages)
+
+        chat_tokens = chat_history.total_tokens
+        summary_tokens = chat_history.summary_tokens(summary)
+        return summary, chat_tokens, summary_tokens, chat_tokens + summary_tokens
+
 # ==========================================================
 #               FILESYSTEM / LOGGING
 # ==========================================================
 def ensure_dir_exists(path):
     if not os.path.exists(path):
-        os.makedirs(path)
-
-def log_chat_message(user_msg, assistant_msg, json_log_path):
-    entry = {
-        "timestamp": datetime.utcnow().isoformat() + "Z",
-        "user": user_msg,
-        "assistant": assistant_msg,
-    }
-    with open(json_log_path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
\ No newline at end of file
+        os.makedirs(path)
\ No newline at end of file